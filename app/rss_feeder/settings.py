@@ -25,6 +25,88 @@ REST_FRAMEWORK = {
 
 # number of retries when trying to fetch a feed for update
 MAX_FEED_UPDATE_RETRIES = 3
+# a failed update is retried by a delayed message after FEED_RETRY_BASE_DELAY 
+# seconds, doubled at each failure in a row up to FEED_RETRY_MAX_DELAY
+FEED_RETRY_BASE_DELAY = 30
+FEED_RETRY_MAX_DELAY = 30 * 60
+
+# seconds to wait for a feed server before giving up on a fetch
+FEED_FETCH_TIMEOUT = 30
+
+FEED_FETCH_USER_AGENT = 'rss-scraper/1.0 (+https://github.com/RSaab/rss-scraper)'
+
+# size of the keep-alive connection pool shared by the fetches of a worker process
+FEED_FETCH_MAX_CONNECTIONS = 200
+FEED_FETCH_KEEPALIVE = 30
+
+# politeness limits per host: requests per second (rate) in bursts of up to 
+# `burst`, and requests at once (concurrency). Requests over the limits wait
+# in the worker's queue. 'default' applies to every host without an entry
+FEED_FETCH_HOST_LIMITS = {
+    'default': {'rate': 2, 'burst': 5, 'concurrency': 4},
+    # 'feeds.feedburner.com': {'rate': 10, 'burst': 20, 'concurrency': 10},
+}
+
+# longest Retry-After (seconds) honoured before the next request to a host
+FEED_FETCH_MAX_PAUSE = 60
+
+# feed documents larger than FEED_MAX_BYTES are rejected, documents larger
+# than FEED_STREAM_THRESHOLD are spooled to disk and parsed one entry at a time.
+# Only the first FEED_MAX_ENTRIES entries of a document are read, and they are
+# normalised, sanitised and written ENTRY_STREAM_BATCH_SIZE at a time
+FEED_MAX_BYTES = 50 * 1024 * 1024
+FEED_STREAM_THRESHOLD = 1024 * 1024
+FEED_MAX_ENTRIES = 5000
+ENTRY_STREAM_BATCH_SIZE = 200
+
+# number of sources fetched concurrently by one scheduled update message
+FEED_UPDATE_BATCH_SIZE = 100
+
+# adaptive scheduling of the feed updates, all durations in seconds
+# due sources are dispatched every SCHEDULER_TICK, in batches spread over the tick
+SCHEDULER_TICK = 60
+SCHEDULER_BATCH_SIZE = 20
+SCHEDULER_MAX_DISPATCH = 5000
+# a dispatched source is not dispatched again before its update pushes it back
+SCHEDULER_CLAIM_TIMEOUT = 15 * 60
+# bounds of the interval between two fetches of a source
+SCHEDULER_MIN_INTERVAL = 5 * 60
+SCHEDULER_MAX_INTERVAL = 24 * 60 * 60
+SCHEDULER_DEFAULT_INTERVAL = 60 * 60
+# weight of the last fetch in the smoothed rate of new entries
+SCHEDULER_RATE_SMOOTHING = 0.3
+
+# maximum number of entries written by a single INSERT ... ON CONFLICT statement
+ENTRY_UPSERT_BATCH_SIZE = 500
+
+# number of characters of the plain text excerpt of an entry, sent in summaries
+ENTRY_EXCERPT_LENGTH = 280
+
+# notifications are written NOTIFICATION_WRITE_BATCH_SIZE at a time. Read
+# notifications older than NOTIFICATION_RETENTION_DAYS are deleted by a daily
+# job, NOTIFICATION_PRUNE_BATCH_SIZE at a time
+NOTIFICATION_WRITE_BATCH_SIZE = 500
+NOTIFICATION_RETENTION_DAYS = 30
+NOTIFICATION_PRUNE_BATCH_SIZE = 1000
+
+# entries published more than ENTRY_RETENTION_DAYS ago, and the entries of a 
+# feed past its newest ENTRY_RETENTION_MAX_ENTRIES, are deleted by a daily job
+# (None keeps them all, feeds can set their own limits). Unread entries are
+# kept if ENTRY_RETENTION_KEEP_UNREAD. Entries are deleted 
+# ENTRY_DELETE_BATCH_SIZE at a time, by the job and when a feed is deleted
+ENTRY_RETENTION_DAYS = 180
+ENTRY_RETENTION_MAX_ENTRIES = 5000
+ENTRY_RETENTION_KEEP_UNREAD = True
+ENTRY_DELETE_BATCH_SIZE = 1000
+
+# the feed updates are traced from force_update() or the scheduler to the
+# recorded outcome, as JSON log records (rss_feeder_api.tracing). A trace is logged
+# in full with a probability of TRACE_SAMPLE_RATE, spans slower than 
+# TRACE_SLOW_SECONDS and failures always are. Records are written to 
+# TRACE_LOG_FILE, or to stdout if it is not set
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+TRACE_SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", 10))
+TRACE_LOG_FILE = os.environ.get("TRACE_LOG_FILE", None)
 
 SWAGGER_SETTINGS = {
     'PERSIST_AUTH': True,
@@ -243,6 +325,11 @@ ALLOWED_STYLES = getattr(
     settings, 'RSS_FEEDER_ALLOWED_STYLES', bleach.ALLOWED_STYLES,
 )
 
+# number of sanitised contents kept in memory by each worker process
+SANITIZER_CACHE_SIZE = getattr(
+    settings, 'RSS_FEEDER_SANITIZER_CACHE_SIZE', 10000,
+)
+
 
 
 DRAMATIQ_BROKER = {
@@ -254,7 +341,7 @@ DRAMATIQ_BROKER = {
         "dramatiq.middleware.Prometheus",
         "dramatiq.middleware.AgeLimit",
         "dramatiq.middleware.TimeLimit",
-        "dramatiq.middleware.Callbacks",
+        "rss_feeder_api.tracing.TraceMiddleware",
         "dramatiq.middleware.Retries",
         "django_dramatiq.middleware.AdminMiddleware",
         "django_dramatiq.middleware.DbConnectionsMiddleware",
@@ -262,9 +349,41 @@ DRAMATIQ_BROKER = {
 }
 
 if not DRAMATIQ_BROKER['BROKER'] == 'dramatiq.brokers.stub.StubBroker':
-    DRAMATIQ_BROKER['OPTIONS'] = {"url": os.environ.get("DRAMATIQ_BROKER_URL", "amqp://localhost:5672")}
+    DRAMATIQ_BROKER['OPTIONS'] = {
+        "url": os.environ.get("DRAMATIQ_BROKER_URL", "amqp://localhost:5672"),
+        # wait for the broker to acknowledge each published message
+        "confirm_delivery": True,
+    }
 
 BROKER_URL = os.environ.get("DRAMATIQ_BROKER_URL", "amqp://localhost:5672")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "json": {
+            "()": "rss_feeder_api.tracing.JSONFormatter",
+        },
+    },
+    "handlers": {
+        "trace": {
+            "class": "logging.FileHandler",
+            "filename": TRACE_LOG_FILE,
+            "formatter": "json",
+        } if TRACE_LOG_FILE else {
+            "class": "logging.StreamHandler",
+            "stream": "ext://sys.stdout",
+            "formatter": "json",
+        },
+    },
+    "loggers": {
+        "rss_feeder.trace": {
+            "handlers": ["trace"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}
 CELERY_RESULT_BACKEND = os.environ.get("DRAMATIQ_BROKER_URL", "amqp://localhost:5672")
 
 
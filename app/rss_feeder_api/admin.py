@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Feed
+from .models import Feed, FeedSource
 
 # Register your models here.
-admin.site.register(Feed)
\ No newline at end of file
+admin.site.register(Feed)
+admin.site.register(FeedSource)
\ No newline at end of file
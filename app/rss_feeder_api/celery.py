@@ -2,6 +2,8 @@ import os
 from celery import Celery
 from celery.schedules import crontab
 
+from rss_feeder.settings import SCHEDULER_TICK
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rss_feeder.settings')
  
 app = Celery('rss_feeder')
@@ -11,9 +13,17 @@ app.config_from_object('django.conf:settings')
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    'auto-update-feeds': {
-        'task': 'rss_feeder_api.tasks.my_scheduled_job',
-        'schedule': crontab(minute=0, hour=0), # run daily at midnight
+    'dispatch-due-feeds': {
+        'task': 'rss_feeder_api.tasks.dispatch_due_sources',
+        'schedule': float(SCHEDULER_TICK), # each source is fetched when it is due
+    },
+    'prune-notifications': {
+        'task': 'rss_feeder_api.tasks.prune_notifications',
+        'schedule': crontab(hour=3, minute=30), # daily, outside of peak hours
+    },
+    'prune-entries': {
+        'task': 'rss_feeder_api.tasks.prune_entries',
+        'schedule': crontab(hour=4, minute=0),
     },
 }
 
@@ -1,2 +1,7 @@
 ENTRY_UNREAD = 0
-ENTRY_READ = 1
\ No newline at end of file
+ENTRY_READ = 1
+
+# kinds of notifications, repeated ones of the same kind and feed are merged
+NOTIFICATION_UPDATED = 'updated'
+NOTIFICATION_FAILED = 'failed'
+NOTIFICATION_BACKOFF = 'backoff'
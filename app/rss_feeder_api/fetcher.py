@@ -0,0 +1,281 @@
+import asyncio
+import atexit
+import hashlib
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+from rss_feeder import settings
+from rss_feeder_api import metrics
+
+
+class FetchError(Exception):
+    """
+    The feed document could not be downloaded (dns, connection, timeout...)
+    """
+    pass
+
+
+class FetchResult(object):
+    '''
+    The raw outcome of fetching a feed document over http
+
+        status          http status of the final response
+        url             the url the document was finally served from
+        moved           True if the document was permanently redirected to url
+        file            the response body, kept in memory up to 
+                        FEED_STREAM_THRESHOLD bytes and spooled to disk above
+        size            number of bytes in the body (0 on 304)
+        body_hash       sha1 of the body, computed while downloading
+        headers         response headers, used by the parser to detect the encoding
+        etag            validators to send on the next conditional request
+        modified
+    '''
+    def __init__(self, status, url, moved=False, file=None, size=0, body_hash=None, headers=None, etag=None, modified=None):
+        self.status = status
+        self.url = url
+        self.moved = moved
+        self.file = file
+        self.size = size
+        self.body_hash = body_hash
+        self.headers = headers or {}
+        self.etag = etag
+        self.modified = modified
+
+    def read(self):
+        '''
+        returns the whole body as bytes
+        '''
+        if self.file is None:
+            return b''
+        self.file.seek(0)
+        return self.file.read()
+
+
+class HostLimiter(object):
+    '''
+    Politeness limits for the requests to one host: at most `concurrency`
+    requests at once, and on average `rate` requests per second in bursts
+    of up to `burst` (a token bucket). 
+
+    Requests over the limits wait for their turn instead of failing.
+    Only used from the engine's event loop, so it needs no locking.
+    '''
+    def __init__(self, rate, burst, concurrency):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def pause(self, seconds):
+        """
+        stop sending requests for a while, when the host asks for it
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            await self._take_token()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
+class FetchEngine(object):
+    '''
+    Downloads feed documents concurrently on an asyncio event loop running
+    in a background thread.
+
+    All the worker threads of a process share the loop and its pool of
+    keep-alive connections, so a batch of hundreds of feeds is fetched in
+    about the time of the slowest one, and only then handed to the parser.
+
+    Requests to the same host are throttled by a HostLimiter, configured by
+    host_limits (see FEED_FETCH_HOST_LIMITS in the settings)
+    '''
+    def __init__(self, host_limits=None):
+        self.host_limits = host_limits or settings.FEED_FETCH_HOST_LIMITS
+        self._limiters = {}
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='feed-fetcher', daemon=True)
+            thread.start()
+
+            self._session = asyncio.run_coroutine_threadsafe(self._create_session(), loop).result()
+            self._loop = loop
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = self._session = None
+
+    async def _create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=settings.FEED_FETCH_MAX_CONNECTIONS,
+            keepalive_timeout=settings.FEED_FETCH_KEEPALIVE,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=settings.FEED_FETCH_TIMEOUT),
+            headers={'User-Agent': settings.FEED_FETCH_USER_AGENT},
+        )
+
+    def _limiter(self, host):
+        limiter = self._limiters.get(host, None)
+        if limiter is None:
+            limits = dict(self.host_limits['default'])
+            limits.update(self.host_limits.get(host, {}))
+            limiter = self._limiters[host] = HostLimiter(**limits)
+        return limiter
+
+    async def _fetch(self, link, etag=None, modified=None):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        host = metrics.host(link)
+        limiter = self._limiter(host)
+        try:
+            async with limiter:
+                start = time.perf_counter()
+                try:
+                    async with self._session.get(link, headers=headers) as response:
+                        body, size, body_hash = await self._read_body(response)
+                except BaseException:
+                    metrics.fetch_seconds.labels(host, 'error').observe(time.perf_counter() - start)
+                    raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise FetchError(str(e) or e.__class__.__name__)
+
+        outcome = 'ok' if response.status < 400 else 'http_error'
+        metrics.fetch_seconds.labels(host, outcome).observe(time.perf_counter() - start)
+        metrics.fetch_bytes.labels(host).observe(size)
+        metrics.fetch_responses.labels(host, str(response.status)).inc()
+
+        # the host is overloaded, hold the other requests to it back
+        if response.status in (429, 503):
+            try:
+                limiter.pause(min(int(response.headers.get('Retry-After', 0)), settings.FEED_FETCH_MAX_PAUSE))
+            except ValueError:
+                pass
+
+        moved = any(r.status in (301, 308) for r in response.history)
+
+        return FetchResult(
+            response.status,
+            str(response.url),
+            moved=moved,
+            file=body,
+            size=size,
+            body_hash=body_hash,
+            headers=dict((k.lower(), v) for k, v in response.headers.items()),
+            etag=response.headers.get('ETag', None),
+            modified=response.headers.get('Last-Modified', None),
+        )
+
+    async def _read_body(self, response):
+        '''
+        reads the response in chunks, hashing it on the way, into a file 
+        that only goes to disk for large documents
+
+        raises FetchError if the document is larger than FEED_MAX_BYTES
+        '''
+        max_bytes = settings.FEED_MAX_BYTES
+        if (response.content_length or 0) > max_bytes:
+            raise FetchError('Feed document larger than %s bytes' % max_bytes)
+
+        body = tempfile.SpooledTemporaryFile(max_size=settings.FEED_STREAM_THRESHOLD)
+        digest = hashlib.sha1()
+        size = 0
+
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+            if size > max_bytes:
+                body.close()
+                raise FetchError('Feed document larger than %s bytes' % max_bytes)
+
+            digest.update(chunk)
+            body.write(chunk)
+
+        body.seek(0)
+        return body, size, digest.hexdigest()
+
+    async def _fetch_all(self, requests):
+        return await asyncio.gather(
+            *[self._fetch(*request) for request in requests],
+            return_exceptions=True,
+        )
+
+    def fetch_many(self, requests):
+        '''
+        Download many feed documents at once, blocking the calling thread
+        until all of them are done
+
+        Arguments:
+            requests    list of (link, etag, modified) tuples
+
+        Returns:
+            a list with a FetchResult or a FetchError for each request, in order
+        '''
+        self._start()
+        return asyncio.run_coroutine_threadsafe(self._fetch_all(requests), self._loop).result()
+
+
+# one engine per process
+engine = FetchEngine()
+atexit.register(engine.close)
+
+
+def fetch(link, etag=None, modified=None):
+    '''
+    Download a feed document, sending the validators of the previous
+    fetch (if any) so that the server can answer with a 304
+
+    returns a FetchResult
+    '''
+    result = engine.fetch_many([(link, etag, modified)])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def fetch_many(requests):
+    return engine.fetch_many(requests)
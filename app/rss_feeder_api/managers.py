@@ -1,44 +1,253 @@
-from django.db import models
+from django.db import models, connections, transaction
 
-import bleach
 import datetime
+import hashlib
+import html
 import time
 
 from django.utils import timezone
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
 
 from rss_feeder import settings
 from rss_feeder_api.constants import ENTRY_UNREAD, ENTRY_READ
+from rss_feeder_api.sanitizer import sanitizer
+from rss_feeder_api import metrics
+
+def _added(field, key, values):
+    """
+    Return field plus a value per row, {key value: value}, as an expression
+    for a single UPDATE of all the rows: field + CASE key WHEN ... END
+    """
+    return models.F(field) + models.Case(
+        *[models.When(**{key: pk, 'then': models.Value(value)}) for pk, value in values.items()],
+        default=models.Value(0),
+        output_field=models.IntegerField(),
+    )
+
+class FeedSourceManager(models.Manager):
+    def followed(self):
+        """
+        Return the sources with at least one unflagged feed
+        """
+        Feed = self.model._meta.get_field('feeds').related_model
+        unflagged = Feed.objects.filter(source=models.OuterRef('pk'), flagged=False, deleted=False)
+
+        return self.filter(models.Exists(unflagged))
+
+    def due(self, now=None):
+        """
+        Return the sources to fetch by now, earliest first, leaving out the
+        sources whose feeds are all flagged
+        """
+        now = now or timezone.now()
+        return self.followed().filter(next_fetch_at__lte=now).order_by('next_fetch_at')
 
 class FeedManager(models.Manager):
-    pass
+    def add_counts(self, counts, owners=None):
+        """
+        Add to the unread and total entry counters of feeds, and of their 
+        owners, with one UPDATE of all the feeds and one of all the owners
+
+        Arguments:
+            counts      {feed_id: (unread, total)}, negative numbers to subtract
+            owners      {feed_id: owner_id} of the feeds if known, read from 
+                        the database otherwise
+        """
+        counts = dict((feed_id, count) for feed_id, count in counts.items() if any(count))
+        if not counts:
+            return
+
+        self.filter(pk__in=list(counts)).update(
+            unread_count=_added('unread_count', 'pk', dict((feed_id, unread) for feed_id, (unread, _) in counts.items())),
+            entry_count=_added('entry_count', 'pk', dict((feed_id, total) for feed_id, (_, total) in counts.items())),
+        )
+
+        if owners is None:
+            owners = dict(self.filter(pk__in=list(counts)).values_list('id', 'owner_id'))
+
+        owner_counts = {}
+        for feed_id, (unread, total) in counts.items():
+            owner_unread, owner_total = owner_counts.get(owners[feed_id], (0, 0))
+            owner_counts[owners[feed_id]] = (owner_unread + unread, owner_total + total)
+
+        User = self.model._meta.get_field('owner').related_model
+        User._meta.get_field('counter').related_model.objects.add_counts(owner_counts)
+
+class UserCounterManager(models.Manager):
+    def add_counts(self, counts):
+        """
+        Add to the unread and total entry counters of users, and bump their 
+        version, with a single UPDATE
+
+        Arguments:
+            counts      {user_id: (unread, total)}, negative numbers to subtract
+        """
+        if not counts:
+            return
+
+        self.filter(user_id__in=list(counts)).update(
+            unread_count=_added('unread_count', 'user_id', dict((user_id, unread) for user_id, (unread, _) in counts.items())),
+            entry_count=_added('entry_count', 'user_id', dict((user_id, total) for user_id, (_, total) in counts.items())),
+            version=models.F('version') + 1,
+        )
+
+    def touch(self, user_ids):
+        """
+        Bump the version of users, whenever something they can read changed
+
+        Arguments:
+            user_ids    a list or a queryset of user ids
+        """
+        if isinstance(user_ids, models.QuerySet):
+            user_ids = list(user_ids)
+        if not user_ids:
+            return
+
+        self.filter(user_id__in=set(user_ids)).update(version=models.F('version') + 1)
+
+class NotificationManager(models.Manager):
+    def coalesce(self, notifications):
+        """
+        Write notifications, merging each one into the unread notification of
+        the same feed and kind if there is one: its count goes up, it takes 
+        the new title and message and comes back on top of the list. 
+
+        Takes three queries per batch of NOTIFICATION_WRITE_BATCH_SIZE, 
+        whatever the number of notifications
+
+        Arguments:
+            notifications   unsaved Notification instances
+        """
+        # the repeated notifications of the list are merged first
+        merged = {}
+        for notification in notifications:
+            key = (notification.feed_id, notification.kind)
+            if key in merged:
+                notification.count += merged[key].count
+            merged[key] = notification
+
+        merged = list(merged.items())
+        batch_size = settings.NOTIFICATION_WRITE_BATCH_SIZE
+        for i in range(0, len(merged), batch_size):
+            self._coalesce(dict(merged[i:i + batch_size]))
+
+    def _coalesce(self, merged):
+        # the latest unread notification of each feed and kind
+        existing = dict(
+            ((feed_id, kind), pk) for pk, feed_id, kind in self.filter(
+                state=ENTRY_UNREAD,
+                feed_id__in=set(feed_id for feed_id, _ in merged),
+                kind__in=set(kind for _, kind in merged),
+            ).order_by('id').values_list('id', 'feed_id', 'kind')
+        )
+
+        updates = [(existing[key], notification) for key, notification in merged.items() if key in existing]
+        if updates:
+            def case(field, output_field):
+                return models.Case(
+                    *[models.When(pk=pk, then=models.Value(getattr(notification, field))) for pk, notification in updates],
+                    output_field=output_field,
+                )
+
+            self.filter(pk__in=[pk for pk, _ in updates]).update(
+                count=models.F('count') + case('count', models.IntegerField()),
+                title=case('title', models.CharField()),
+                message=case('message', models.CharField()),
+                updated_at=timezone.now(),
+            )
+
+        self.bulk_create([notification for key, notification in merged.items() if key not in existing])
+
+    def prune(self, before, batch_size=None):
+        """
+        Delete the read notifications last updated before a time, a batch at
+        a time so that no statement holds locks for long
+
+        Returns:
+            the number of deleted notifications
+        """
+        batch_size = batch_size or settings.NOTIFICATION_PRUNE_BATCH_SIZE
+        User = self.model._meta.get_field('owner').related_model
+        counters = User._meta.get_field('counter').related_model.objects
+
+        deleted = 0
+        while True:
+            batch = list(self.filter(state=ENTRY_READ, updated_at__lt=before).values_list('id', 'owner_id')[:batch_size])
+            if not batch:
+                break
+
+            with transaction.atomic(using=self.db):
+                self.filter(pk__in=[pk for pk, _ in batch]).delete()
+                counters.touch([owner_id for _, owner_id in batch])
+            deleted += len(batch)
+
+        return deleted
+
+class UpsertManager(models.Manager):
+    def upsert(self, objs, unique_fields, update_fields, batch_size=None):
+        """
+        Insert objects, updating update_fields of the rows that already exist
+        for the same unique_fields, with one INSERT ... ON CONFLICT DO UPDATE
+        statement per batch. Supported by PostgreSQL and SQLite >= 3.24
+        """
+        if not objs:
+            return
+
+        connection = connections[self.db]
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+
+        fields = [f for f in opts.concrete_fields if not f.primary_key]
+        update_columns = [opts.get_field(name).column for name in update_fields]
+
+        batch_size = min(
+            batch_size or settings.ENTRY_UPSERT_BATCH_SIZE,
+            connection.ops.bulk_batch_size(fields, objs) or len(objs),
+        )
+
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        sql = 'INSERT INTO %s (%s) VALUES %%s ON CONFLICT (%s) DO UPDATE SET %s' % (
+            qn(opts.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            ', '.join(qn(opts.get_field(name).column) for name in unique_fields),
+            ', '.join('%s = EXCLUDED.%s' % (qn(column), qn(column)) for column in update_columns),
+        )
+
+        with connection.cursor() as cursor:
+            for i in range(0, len(objs), batch_size):
+                batch = objs[i:i + batch_size]
+                params = [
+                    f.get_db_prep_save(f.pre_save(obj, True), connection)
+                    for obj in batch
+                    for f in fields
+                ]
+                cursor.execute(sql % ', '.join([row] * len(batch)), params)
+
+class ItemManager(UpsertManager):
+    # fields overwritten when an item is updated by a newer version in the feed
+    UPSERT_FIELDS = ['title', 'content', 'excerpt', 'content_hash', 'date', 'author', 'url', 'comments_url', 'last_updated']
 
-class EntryManager(models.Manager):   
-    def parseFromFeed(self, raw):
+    def parseFromFeed(self, raw, sanitize=True):
         """
-        Create an Entry object from a raw feedparser entry
+        Create an Item object from a raw feedparser entry
         
         Arguments:
             raw         The raw feed entry (aka item)
+            sanitize    If False the content is left as published, call 
+                        sanitize() on the item before saving it
         
         Returns:
-            entry       An Entry instance (not saved)
+            item        An Item instance (not saved, without its source)
         """
 
-        entry = self.model()
+        item = self.model()
         
-        entry.title = raw.get('title', '')
+        item.title = raw.get('title', '')
         content = raw.get('content', [{'value': ''}])[0]['value']
         if not content:
             content = raw.get('description', '')
-        
-        # Sanitise the content
-        entry.content = bleach.clean(
-            content,
-            tags=settings.ALLOWED_TAGS,
-            attributes=settings.ALLOWED_ATTRIBUTES,
-            styles=settings.ALLOWED_STYLES,
-            strip=True,
-        )
+        item.content = content
         
         # Order: updated, published, created
         # If not provided, needs to be None for update comparison
@@ -53,20 +262,344 @@ class EntryManager(models.Manager):
         
         # TODO handle timezone warnings
         if date is not None:
-            entry.date = datetime.datetime.fromtimestamp(
+            item.date = datetime.datetime.fromtimestamp(
                 time.mktime(date)
             )
         
-        entry.url = raw.get('link', '')
-        entry.guid = raw.get('guid', entry.url)
+        item.url = raw.get('link', '')
+        item.guid = raw.get('guid', item.url)
         
-        entry.author = raw.get('author', '')
-        entry.comments_url = raw.get('comments', '')
+        item.author = raw.get('author', '')
+        item.comments_url = raw.get('comments', '')
 
-        entry.last_updated = timezone.now()
+        item.last_updated = timezone.now()
+
+        item.content_hash = self.contentHash(item)
+
+        if sanitize:
+            self.sanitize(item)
         
-        return entry
+        return item
+
+    def contentHash(self, item):
+        """
+        Return a digest of the normalised title, content, url and author of
+        an item, used to tell whether a published item really changed
+        """
+        values = [item.title, item.content, item.url, item.author]
+        normalised = '\x1f'.join(' '.join((value or '').split()) for value in values)
+        return hashlib.sha1(normalised.encode('utf-8')).hexdigest()
+
+    def sanitize(self, item):
+        """
+        Sanitise the html content of an item, in place, and derive its excerpt
+        """
+        item.content = sanitizer.clean(item.content)
+        item.excerpt = self.excerpt(item.content)
+
+    def excerpt(self, content):
+        """
+        Return the beginning of an html content as plain text, cut on a word
+        """
+        text = ' '.join(html.unescape(strip_tags(content or '')).split())
+        return Truncator(text).chars(settings.ENTRY_EXCERPT_LENGTH)
         
+    def orphaned(self):
+        """
+        Return the items no feed has an entry for anymore
+        """
+        Entry = self.model._meta.get_field('entries').related_model
+        return self.filter(~models.Exists(Entry.objects.filter(item=models.OuterRef('pk'))))
+
+    def prune(self, batch_size=None):
+        """
+        Delete the orphaned items, a batch of ENTRY_DELETE_BATCH_SIZE at a time
+
+        Returns:
+            the number of deleted items
+        """
+        batch_size = batch_size or settings.ENTRY_DELETE_BATCH_SIZE
+
+        deleted = 0
+        while True:
+            batch = list(self.orphaned().order_by().values_list('id', flat=True)[:batch_size])
+            if not batch:
+                break
+
+            self.filter(pk__in=batch).delete()
+            deleted += len(batch)
+
+        return deleted
+
+class EntryManager(UpsertManager):   
+    # fields overwritten when an entry's item is updated by a newer version in the feed
+    UPSERT_FIELDS = ['state', 'date', 'updated_at']
+
+    def reconcile(self, source, feeds, parsed):
+        """
+        Write the parsed items of a source, and an entry of each to each of
+        its feeds
+
+        The guid and content hash of the stored items are loaded in a single
+        query and compared in memory: new items are inserted and items whose 
+        content changed are updated, once whatever the number of feeds, the 
+        rest is skipped. Only the items that are written get sanitised.
+
+        Each feed then gets an unread entry for the items it has no entry 
+        for yet, unless they were published before the entries the retention
+        job deleted from it (Feed.pruned_until), and its entries of the 
+        updated items are marked unread again. The unread and total counters
+        of the feeds are updated to match.
+
+        Must run in a transaction: the row of the source is locked first, so 
+        that concurrent updates of the same source read the stored items and
+        entries only once the previous one is committed, and do not add the 
+        same entries to the counters twice.
+
+        Arguments:
+            source      the FeedSource the items were published by
+            feeds       the Feed instances to write to
+            parsed      unsaved Item instances as returned by 
+                        Item.objects.parseFromFeed(raw, sanitize=False)
+
+        Returns:
+            (created, updated)  the number of entries inserted and updated
+        """
+        # a guid repeated in the document would hit the same row twice in one upsert
+        parsed = list(dict((item.guid, item) for item in parsed).values())
+        if not feeds or not parsed:
+            return 0, 0
+
+        Item = self.model._meta.get_field('item').related_model
+        guids = [item.guid for item in parsed]
+
+        # SQLite has no row locks, but a single writer: the second of two 
+        # concurrent updates fails to write rather than count entries twice
+        if connections[self.db].features.has_select_for_update:
+            list(type(source)._default_manager.select_for_update().filter(pk=source.pk).values_list('pk'))
+
+        with metrics.db_seconds.labels('read').time():
+            stored = {
+                guid: (pk, content_hash, date)
+                for pk, guid, content_hash, date in Item.objects.filter(
+                    source=source, guid__in=guids,
+                ).values_list('id', 'guid', 'content_hash', 'date')
+            }
+
+        # sanitise and write each new or changed item once
+        now = timezone.now()
+        written = [item for item in parsed if item.guid not in stored or item.content_hash != stored[item.guid][1]]
+        with metrics.sanitize_seconds.time():
+            for item in written:
+                item.source = source
+                if item.date is None:
+                    item.date = now
+                Item.objects.sanitize(item)
+
+        start = time.perf_counter()
+        Item.objects.upsert(written, ['source', 'guid'], Item.objects.UPSERT_FIELDS)
+
+        # the id and publication date of every parsed item. The items stored 
+        # without a hash (before there was one) get theirs, they are not 
+        # taken for changed
+        changed = set(item.guid for item in written if item.guid in stored and stored[item.guid][1] is not None)
+        items = dict((guid, (pk, date)) for guid, (pk, _, date) in stored.items())
+        items.update((item.guid, (stored[item.guid][0], item.date)) for item in written if item.guid in stored)
+
+        inserted = [item.guid for item in written if item.guid not in stored]
+        if inserted:
+            items.update(
+                (guid, (pk, date)) for pk, guid, date in Item.objects.filter(
+                    source=source, guid__in=inserted,
+                ).values_list('id', 'guid', 'date')
+            )
+
+        states = {
+            (feed_id, item_id): state
+            for feed_id, item_id, state in self.filter(
+                feed__in=feeds, item_id__in=[pk for pk, _ in items.values()],
+            ).values_list('feed_id', 'item_id', 'state')
+        }
+
+        created = []
+        updated = []
+        counts = {}
+        for feed in feeds:
+            unread = total = 0
+            for guid in guids:
+                item_id, date = items[guid]
+                entry = self.model(feed=feed, item_id=item_id, state=ENTRY_UNREAD, date=date)
+
+                key = (feed.id, item_id)
+                if key not in states:
+                    if feed.pruned_until is not None and date <= feed.pruned_until:
+                        continue
+                    created.append(entry)
+                    unread += 1
+                    total += 1
+                elif guid in changed:
+                    updated.append(entry)
+                    if states[key] != ENTRY_UNREAD:
+                        unread += 1
+            counts[feed.id] = (unread, total)
+
+        self.upsert(created + updated, ['feed', 'item'], self.UPSERT_FIELDS)
+
+        Feed = self.model._meta.get_field('feed').related_model
+        Feed.objects.add_counts(counts, owners=dict((feed.id, feed.owner_id) for feed in feeds))
+        metrics.db_seconds.labels('write').observe(time.perf_counter() - start)
+
+        metrics.entries.labels('created').inc(len(inserted))
+        metrics.entries.labels('updated').inc(len(changed))
+        metrics.entries.labels('skipped').inc(len(parsed) - len(written))
+
+        return len(created), len(updated)
+
+    def subscribe(self, feed):
+        """
+        Give a feed that was just attached to its source an unread entry of
+        the newest items the source already has: the next fetch of a source
+        that other feeds follow is likely not modified, and would not add them
+
+        Arguments:
+            feed        the saved Feed instance
+
+        Returns:
+            the number of entries inserted
+        """
+        Item = self.model._meta.get_field('item').related_model
+        items = list(
+            Item.objects.filter(source_id=feed.source_id)
+            .order_by('-date')
+            .values_list('id', 'date')[:settings.FEED_MAX_ENTRIES]
+        )
+        if not items:
+            return 0
+
+        existing = set(self.filter(
+            feed=feed, item_id__in=[pk for pk, _ in items],
+        ).values_list('item_id', flat=True))
+        created = [
+            self.model(feed=feed, item_id=pk, state=ENTRY_UNREAD, date=date)
+            for pk, date in items if pk not in existing
+        ]
+
+        self.upsert(created, ['feed', 'item'], self.UPSERT_FIELDS)
+
+        Feed = self.model._meta.get_field('feed').related_model
+        Feed.objects.add_counts({feed.id: (len(created), len(created))}, owners={feed.id: feed.owner_id})
+
+        return len(created)
+
+    def mark(self, entries, state):
+        """
+        Set the state of many entries, keeping the unread counters of their 
+        feeds: one UPDATE of the entries in the other state per feed, then a
+        single one of the counters. The counters are moved by the row count
+        of each UPDATE, the entries that really changed, so that concurrent 
+        marks of the same entries do not count them twice
+
+        Arguments:
+            entries     a queryset of the entries to mark
+            state       ENTRY_READ or ENTRY_UNREAD
+
+        Returns:
+            the number of entries whose state changed
+        """
+        entries = entries.filter(state=ENTRY_UNREAD if state == ENTRY_READ else ENTRY_READ)
+        sign = -1 if state == ENTRY_READ else 1
+
+        with transaction.atomic(using=self.db):
+            counts = {}
+            for feed_id in list(entries.order_by().values_list('feed_id', flat=True).distinct()):
+                counts[feed_id] = entries.filter(feed_id=feed_id).update(state=state)
+
+            Feed = self.model._meta.get_field('feed').related_model
+            Feed.objects.add_counts(dict((feed_id, (sign * count, 0)) for feed_id, count in counts.items()))
+
+        return sum(counts.values())
+
+    def prune(self, feed, max_age=None, max_entries=None, keep_unread=True):
+        """
+        Delete the entries of a feed published more than max_age ago, or past 
+        its newest max_entries, a batch at a time. The date of the newest 
+        deleted entry is kept as the feed's pruned_until, so that the next
+        updates of its source do not write them again
+
+        Arguments:
+            feed            the Feed to prune
+            max_age         a timedelta, or None for no age limit
+            max_entries     number of entries to keep, or None for no limit
+            keep_unread     if True only read entries are deleted
+
+        Returns:
+            the number of deleted entries
+        """
+        entries = self.filter(feed=feed)
+
+        expired = models.Q()
+        if max_age is not None:
+            expired |= models.Q(date__lt=timezone.now() - max_age)
+
+        if max_entries is not None:
+            # the newest entry to delete
+            first = list(entries.order_by('-date', '-id').values_list('date', 'id')[max_entries:max_entries + 1])
+            if first:
+                date, pk = first[0]
+                expired |= models.Q(date__lt=date) | models.Q(date=date, id__lte=pk)
+
+        if not expired:
+            return 0
+
+        entries = entries.filter(expired)
+        if keep_unread:
+            entries = entries.filter(state=ENTRY_READ)
+
+        newest = entries.aggregate(newest=models.Max('date'))['newest']
+        if newest is None:
+            return 0
+
+        Feed = self.model._meta.get_field('feed').related_model
+        Feed.objects.filter(pk=feed.pk).filter(
+            models.Q(pruned_until__isnull=True) | models.Q(pruned_until__lt=newest),
+        ).update(pruned_until=newest)
+
+        return self.delete_batches(entries)
+
+    def delete_batches(self, entries, counters=True, batch_size=None):
+        """
+        Delete entries a batch of ENTRY_DELETE_BATCH_SIZE at a time, each in 
+        its own short transaction, so that no statement holds locks for long
+
+        Arguments:
+            entries     a queryset of the entries to delete
+            counters    if True, the counters of their feeds are updated
+
+        Returns:
+            the number of deleted entries
+        """
+        batch_size = batch_size or settings.ENTRY_DELETE_BATCH_SIZE
+        Feed = self.model._meta.get_field('feed').related_model
+
+        deleted = 0
+        while True:
+            batch = list(entries.order_by().values_list('id', 'feed_id', 'state')[:batch_size])
+            if not batch:
+                break
+
+            counts = {}
+            for _, feed_id, state in batch:
+                unread, total = counts.get(feed_id, (0, 0))
+                counts[feed_id] = (unread - int(state == ENTRY_UNREAD), total - 1)
+
+            with transaction.atomic(using=self.db):
+                self.filter(pk__in=[pk for pk, _, _ in batch]).delete()
+                if counters:
+                    Feed.objects.add_counts(counts)
+            deleted += len(batch)
+
+        return deleted
+
     def get_query_set(self):
         """
         Return an EntryQuerySet
@@ -0,0 +1,79 @@
+'''
+Prometheus metrics of the feed update pipeline, one per stage, so that a
+slow update cycle can be told apart between the network (fetch), the cpu
+(parse, sanitise) and the database (read, write).
+
+The dramatiq Prometheus middleware serves the metrics of all the worker
+processes from the files of its directory, which prometheus_client must
+know of before it is first imported. It is set here for the metrics below
+to be served along with the message metrics.
+'''
+
+import os
+
+from urllib.parse import urlsplit
+
+from rss_feeder import settings
+
+if 'dramatiq.middleware.Prometheus' in settings.DRAMATIQ_BROKER['MIDDLEWARE']:
+    from dramatiq.middleware.prometheus import DB_PATH
+    os.environ.setdefault('prometheus_multiproc_dir', DB_PATH)
+
+from prometheus_client import Counter, Histogram
+
+
+# seconds, from a fast local fetch to a slow host
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# bytes, from an empty 304 to FEED_MAX_BYTES
+SIZE_BUCKETS = (0, 1024, 10 * 1024, 50 * 1024, 100 * 1024, 500 * 1024, 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2, 50 * 1024 ** 2)
+
+fetch_seconds = Histogram(
+    'rss_feeder_fetch_seconds',
+    'Time to download a feed document, without the wait for the host limits',
+    ['host', 'outcome'], buckets=LATENCY_BUCKETS,
+)
+fetch_bytes = Histogram(
+    'rss_feeder_fetch_bytes',
+    'Size of the downloaded feed documents',
+    ['host'], buckets=SIZE_BUCKETS,
+)
+fetch_responses = Counter(
+    'rss_feeder_fetch_responses_total',
+    'HTTP responses to the feed requests, by status',
+    ['host', 'status'],
+)
+parse_seconds = Histogram(
+    'rss_feeder_parse_seconds',
+    'Time to parse a feed document (up to its first entry when streamed)',
+    ['parser'], buckets=LATENCY_BUCKETS,
+)
+entry_parse_seconds = Histogram(
+    'rss_feeder_entry_parse_seconds',
+    'Time to read a batch of entries from the document, with parseFromFeed',
+    buckets=LATENCY_BUCKETS,
+)
+sanitize_seconds = Histogram(
+    'rss_feeder_sanitize_seconds',
+    'Time to sanitise the written entries of a batch (bleach)',
+    buckets=LATENCY_BUCKETS,
+)
+db_seconds = Histogram(
+    'rss_feeder_db_seconds',
+    'Time spent in the database to store a batch of entries',
+    ['operation'], buckets=LATENCY_BUCKETS,
+)
+entries = Counter(
+    'rss_feeder_entries_total',
+    'Entries of the fetched documents, by what was done with them',
+    ['result'],
+)
+updates = Counter(
+    'rss_feeder_updates_total',
+    'Updates of the feed sources, by outcome',
+    ['outcome'],
+)
+
+
+def host(link):
+    return (urlsplit(link).hostname or '').lower()
+
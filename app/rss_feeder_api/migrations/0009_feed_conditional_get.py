@@ -0,0 +1,28 @@
+# Generated by Django 3.1 on 2026-10-18 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0008_entry_last_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='body_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='etag',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+    ]
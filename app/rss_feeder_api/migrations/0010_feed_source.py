@@ -0,0 +1,65 @@
+# Generated by Django 3.1 on 2026-10-18 20:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_sources(apps, schema_editor):
+    """
+    one source per distinct feed link, keeping the validators of the first feed
+    """
+    Feed = apps.get_model('rss_feeder_api', 'Feed')
+    FeedSource = apps.get_model('rss_feeder_api', 'FeedSource')
+
+    for feed in Feed.objects.order_by('id'):
+        source, _ = FeedSource.objects.get_or_create(link=feed.link, defaults={
+            'etag': feed.etag,
+            'last_modified': feed.last_modified,
+            'body_hash': feed.body_hash,
+        })
+        feed.source = source
+        feed.save(update_fields=['source'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0009_feed_conditional_get'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedSource',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('link', models.URLField(unique=True)),
+                ('etag', models.CharField(blank=True, max_length=200, null=True)),
+                ('last_modified', models.CharField(blank=True, max_length=50, null=True)),
+                ('body_hash', models.CharField(blank=True, max_length=40, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Feed Source',
+                'verbose_name_plural': 'Feed Sources',
+            },
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='source',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='feeds', to='rss_feeder_api.feedsource'),
+        ),
+        migrations.RunPython(create_sources, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='feed',
+            name='body_hash',
+        ),
+        migrations.RemoveField(
+            model_name='feed',
+            name='etag',
+        ),
+        migrations.RemoveField(
+            model_name='feed',
+            name='last_modified',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0010_feed_source'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='content_hash',
+            field=models.CharField(blank=True, help_text='Digest of the published title, content, url and author', max_length=40, null=True),
+        ),
+    ]
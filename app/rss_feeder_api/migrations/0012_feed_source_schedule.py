@@ -0,0 +1,39 @@
+# Generated by Django 3.1 on 2026-10-18 20:08
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0011_entry_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feedsource',
+            name='entry_rate',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='feedsource',
+            name='failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='feedsource',
+            name='fetched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='feedsource',
+            name='next_fetch_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='feedsource',
+            name='ttl',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
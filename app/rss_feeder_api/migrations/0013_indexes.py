@@ -0,0 +1,37 @@
+# Generated by Django 3.1 on 2026-10-18 20:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0012_feed_source_schedule'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['feed', '-updated_at', '-id'], name='entry_feed_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(condition=models.Q(state=0), fields=['feed', '-updated_at', '-id'], name='entry_unread_feed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(fields=['owner', '-updated_at'], name='feed_owner_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(condition=models.Q(flagged=False), fields=['source'], name='feed_unflagged_source_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['owner', '-updated_at', '-id'], name='notification_owner_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(state=0), fields=['owner', '-updated_at', '-id'], name='notification_unread_owner_idx'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 3.1 on 2026-10-18 20:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_entries(apps, schema_editor):
+    """
+    the counters of the existing feeds, and of their owners
+    """
+    Feed = apps.get_model('rss_feeder_api', 'Feed')
+    Entry = apps.get_model('rss_feeder_api', 'Entry')
+    UserCounter = apps.get_model('rss_feeder_api', 'UserCounter')
+
+    counts = Entry.objects.values('feed_id').annotate(
+        total=models.Count('id'),
+        unread=models.Count('id', filter=models.Q(state=0)),
+    )
+    for count in counts:
+        Feed.objects.filter(pk=count['feed_id']).update(unread_count=count['unread'], entry_count=count['total'])
+
+    owners = Feed.objects.values('owner_id').annotate(
+        unread=models.Sum('unread_count'),
+        total=models.Sum('entry_count'),
+    )
+    for owner in owners:
+        UserCounter.objects.update_or_create(user_id=owner['owner_id'], defaults={
+            'unread_count': owner['unread'],
+            'entry_count': owner['total'],
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rss_feeder_api', '0013_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='entry_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='unread_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='UserCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.IntegerField(default=0)),
+                ('entry_count', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='counter', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'User Counter',
+                'verbose_name_plural': 'User Counters',
+            },
+        ),
+        migrations.RunPython(count_entries, migrations.RunPython.noop),
+    ]
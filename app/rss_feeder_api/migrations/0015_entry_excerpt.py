@@ -0,0 +1,48 @@
+# Generated by Django 3.1 on 2026-10-18 20:25
+
+import html
+
+from django.db import migrations, models
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+
+# frozen copy of the excerpt of the entry manager, with the length at the time
+EXCERPT_LENGTH = 280
+
+
+def excerpt(content):
+    text = ' '.join(html.unescape(strip_tags(content or '')).split())
+    return Truncator(text).chars(EXCERPT_LENGTH)
+
+
+def fill_excerpts(apps, schema_editor):
+    """
+    the excerpt of the existing entries, a thousand at a time
+    """
+    Entry = apps.get_model('rss_feeder_api', 'Entry')
+
+    batch = []
+    for entry in Entry.objects.only('id', 'content').iterator(chunk_size=1000):
+        entry.excerpt = excerpt(entry.content)
+        batch.append(entry)
+        if len(batch) == 1000:
+            Entry.objects.bulk_update(batch, ['excerpt'])
+            batch = []
+    Entry.objects.bulk_update(batch, ['excerpt'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0014_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='excerpt',
+            field=models.TextField(blank=True, help_text='Beginning of the content as plain text, for summaries'),
+        ),
+        migrations.RunPython(fill_excerpts, migrations.RunPython.noop),
+    ]
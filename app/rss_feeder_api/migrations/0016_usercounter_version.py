@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0015_entry_excerpt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usercounter',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
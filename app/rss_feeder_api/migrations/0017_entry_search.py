@@ -0,0 +1,92 @@
+from django.db import migrations
+
+
+# frozen copy of the statements of rss_feeder_api.search at the time, for
+# the index of a table
+def postgresql_statements(table):
+    index = '%s_search_idx' % table.rsplit('_', 1)[-1]
+    install = [
+        """
+        ALTER TABLE {table} ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(content, '')), 'B')
+        ) STORED
+        """.format(table=table),
+        "CREATE INDEX {index} ON {table} USING GIN (search_vector)".format(index=index, table=table),
+    ]
+    uninstall = [
+        "DROP INDEX IF EXISTS {index}".format(index=index),
+        "ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector".format(table=table),
+    ]
+    return install, uninstall
+
+
+def sqlite_statements(table):
+    install = [
+        """
+        CREATE VIRTUAL TABLE {table}_fts USING fts5(
+            title, content, content='{table}', content_rowid='id',
+            tokenize='porter unicode61'
+        )
+        """,
+        """
+        CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts({table}_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END
+        """,
+        """
+        CREATE TRIGGER {table}_fts_update AFTER UPDATE OF title, content ON {table} BEGIN
+            INSERT INTO {table}_fts({table}_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO {table}_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+        """,
+        "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+    ]
+    uninstall = [
+        "DROP TRIGGER IF EXISTS {table}_fts_update",
+        "DROP TRIGGER IF EXISTS {table}_fts_delete",
+        "DROP TRIGGER IF EXISTS {table}_fts_insert",
+        "DROP TABLE IF EXISTS {table}_fts",
+    ]
+    return (
+        [statement.format(table=table) for statement in install],
+        [statement.format(table=table) for statement in uninstall],
+    )
+
+
+def installer(table):
+    """
+    the (install, uninstall) functions of the index of a table
+    """
+    def run(schema_editor, which):
+        vendors = {'postgresql': postgresql_statements, 'sqlite': sqlite_statements}
+        statements = vendors.get(schema_editor.connection.vendor, None)
+        if statements is None:
+            return
+        for statement in statements(table)[which]:
+            schema_editor.execute(statement)
+
+    def install(apps, schema_editor):
+        run(schema_editor, 0)
+
+    def uninstall(apps, schema_editor):
+        run(schema_editor, 1)
+
+    return install, uninstall
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0016_usercounter_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(*installer('rss_feeder_api_entry')),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.1 on 2026-10-18 20:34
+
+from django.db import migrations, models
+
+
+def set_kinds(apps, schema_editor):
+    """
+    the kind of the existing notifications, from their title
+    """
+    Notification = apps.get_model('rss_feeder_api', 'Notification')
+
+    Notification.objects.filter(is_error=True).update(kind='failed')
+    Notification.objects.filter(title='BackOff').update(kind='backoff')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0017_entry_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('updated', 'Updated'), ('failed', 'Failed'), ('backoff', 'Backoff')], default='updated', max_length=20),
+        ),
+        migrations.RunPython(set_kinds, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(state=0), fields=['feed', 'kind'], name='notification_unread_kind_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(state=1), fields=['updated_at'], name='notification_read_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1 on 2026-10-18 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0018_notification_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='deleted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='retention_max_entries',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='feed',
+            unique_together=set(),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['feed', '-date', '-id'], name='entry_feed_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='feed',
+            constraint=models.UniqueConstraint(condition=models.Q(deleted=False), fields=('link', 'owner'), name='feed_unique_link_owner'),
+        ),
+    ]
@@ -0,0 +1,217 @@
+# Generated by Django 3.1 on 2026-10-18 20:47
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# frozen copy of the statements of rss_feeder_api.search at the time, for
+# the index of a table
+def postgresql_statements(table):
+    index = '%s_search_idx' % table.rsplit('_', 1)[-1]
+    install = [
+        """
+        ALTER TABLE {table} ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(content, '')), 'B')
+        ) STORED
+        """.format(table=table),
+        "CREATE INDEX {index} ON {table} USING GIN (search_vector)".format(index=index, table=table),
+    ]
+    uninstall = [
+        "DROP INDEX IF EXISTS {index}".format(index=index),
+        "ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector".format(table=table),
+    ]
+    return install, uninstall
+
+
+def sqlite_statements(table):
+    install = [
+        """
+        CREATE VIRTUAL TABLE {table}_fts USING fts5(
+            title, content, content='{table}', content_rowid='id',
+            tokenize='porter unicode61'
+        )
+        """,
+        """
+        CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts({table}_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END
+        """,
+        """
+        CREATE TRIGGER {table}_fts_update AFTER UPDATE OF title, content ON {table} BEGIN
+            INSERT INTO {table}_fts({table}_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO {table}_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+        """,
+        "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+    ]
+    uninstall = [
+        "DROP TRIGGER IF EXISTS {table}_fts_update",
+        "DROP TRIGGER IF EXISTS {table}_fts_delete",
+        "DROP TRIGGER IF EXISTS {table}_fts_insert",
+        "DROP TABLE IF EXISTS {table}_fts",
+    ]
+    return (
+        [statement.format(table=table) for statement in install],
+        [statement.format(table=table) for statement in uninstall],
+    )
+
+
+def installer(table):
+    """
+    the (install, uninstall) functions of the index of a table
+    """
+    def run(schema_editor, which):
+        vendors = {'postgresql': postgresql_statements, 'sqlite': sqlite_statements}
+        statements = vendors.get(schema_editor.connection.vendor, None)
+        if statements is None:
+            return
+        for statement in statements(table)[which]:
+            schema_editor.execute(statement)
+
+    def install(apps, schema_editor):
+        run(schema_editor, 0)
+
+    def uninstall(apps, schema_editor):
+        run(schema_editor, 1)
+
+    return install, uninstall
+
+
+# the fields moved from the entries to their item
+ITEM_FIELDS = ['title', 'content', 'excerpt', 'content_hash', 'date', 'author', 'url', 'comments_url', 'guid', 'last_updated']
+
+
+def share_items(apps, schema_editor):
+    """
+    one item per source and guid, from the most recently updated of its
+    entries, for all of them. The entries of a feed without a source can
+    not be shared and are deleted
+    """
+    Entry = apps.get_model('rss_feeder_api', 'Entry')
+    Feed = apps.get_model('rss_feeder_api', 'Feed')
+    Item = apps.get_model('rss_feeder_api', 'Item')
+
+    Entry.objects.filter(feed__source=None).delete()
+
+    sources = Feed.objects.exclude(source=None).order_by().values_list('source_id', flat=True).distinct()
+    for source_id in sources.iterator():
+        entries = Entry.objects.filter(feed__source_id=source_id)
+
+        items = {}
+        for entry in entries.order_by('updated_at', 'id').only(*ITEM_FIELDS).iterator(chunk_size=1000):
+            items[entry.guid] = Item(source_id=source_id, **dict((field, getattr(entry, field)) for field in ITEM_FIELDS))
+        Item.objects.bulk_create(items.values(), batch_size=1000)
+
+        entries.update(item=models.Subquery(
+            Item.objects.filter(source_id=source_id, guid=models.OuterRef('guid')).values('id')[:1]
+        ))
+
+
+def unshare_items(apps, schema_editor):
+    """
+    copies the content of the items back to their entries
+    """
+    Entry = apps.get_model('rss_feeder_api', 'Entry')
+    Item = apps.get_model('rss_feeder_api', 'Item')
+
+    Entry.objects.update(**dict(
+        (field, models.Subquery(Item.objects.filter(pk=models.OuterRef('item_id')).values(field)[:1]))
+        for field in ITEM_FIELDS if field != 'date'
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0019_entry_retention'),
+    ]
+
+    operations = [
+        # the search index goes with the title and content, to the items
+        migrations.RunPython(*reversed(installer('rss_feeder_api_entry'))),
+        migrations.CreateModel(
+            name='Item',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.TextField(blank=True)),
+                ('content', models.TextField(blank=True)),
+                ('excerpt', models.TextField(blank=True, help_text='Beginning of the content as plain text, for summaries')),
+                ('date', models.DateTimeField(help_text='When this entry says it was published')),
+                ('author', models.TextField(blank=True)),
+                ('url', models.TextField(blank=True, help_text='URL for the HTML for this entry', validators=[django.core.validators.URLValidator()])),
+                ('comments_url', models.TextField(blank=True, help_text='URL for HTML comment submission page', validators=[django.core.validators.URLValidator()])),
+                ('guid', models.TextField(blank=True, help_text='GUID for the entry, according to the feed')),
+                ('content_hash', models.CharField(blank=True, help_text='Digest of the published title, content, url and author', max_length=40, null=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='rss_feeder_api.feedsource')),
+            ],
+            options={
+                'unique_together': {('source', 'guid')},
+            },
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='item',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='rss_feeder_api.item'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='entry',
+            unique_together=set(),
+        ),
+        migrations.RunPython(share_items, unshare_items),
+        migrations.AlterField(
+            model_name='entry',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='rss_feeder_api.item'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='entry',
+            unique_together={('feed', 'item')},
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='author',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='comments_url',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='content_hash',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='excerpt',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='guid',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='last_updated',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='title',
+        ),
+        migrations.RemoveField(
+            model_name='entry',
+            name='url',
+        ),
+        migrations.RunPython(*installer('rss_feeder_api_item')),
+    ]
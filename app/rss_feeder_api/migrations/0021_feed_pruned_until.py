@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 23:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rss_feeder_api', '0020_shared_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='pruned_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,82 +1,140 @@
 from django.db import models
 
+from django.db import connection
 from django.db import transaction
 from django.shortcuts import get_object_or_404
 
 import datetime
+import itertools
+import logging
+import random
 import time
 
 from django.utils import timezone
 
-import backoff
 import dramatiq
 
 from django.utils.encoding import smart_text as smart_unicode
 from django.utils.translation import ugettext_lazy as _
 
-from rss_feeder_api.constants import ENTRY_UNREAD, ENTRY_READ
+from rss_feeder_api.constants import ENTRY_UNREAD, ENTRY_READ, NOTIFICATION_UPDATED, NOTIFICATION_FAILED, NOTIFICATION_BACKOFF
 
 from rss_feeder_api import managers
+from rss_feeder_api import fetcher
+from rss_feeder_api import metrics
+from rss_feeder_api import tracing
+from rss_feeder_api.streaming import StreamingParser
 
 from django.core.validators import URLValidator
 import feedparser
 
-from rss_feeder.settings import MAX_FEED_UPDATE_RETRIES
+from rss_feeder import settings
 
 import json
 
-def backoff_hdlr(details):
-    print ("Backing off {wait:0.1f} seconds afters {tries} tries "
-           "calling function {target} with args {args} and kwargs "
-           "{kwargs}".format(**details))
-    feed = details['args'][0]
-    wait = details['wait']
-    notification = Notification(feed=feed, owner=feed.owner, title='BackOff', message=f'Feed: {feed.id}, {feed.link} failed to update, retrying in {wait:0.1f}', is_error=True)
-    notification.save()
-
-@dramatiq.actor
-def feed_update_failure(message_data, exception_data):
+def release_connection():
     """
-    A dramatiq callback on each failed attempt for a feed update
-    the user will notified by inserting a notification in the db 
-    only on the final failure
-
-    TODO: log all errors to somewhere for metrics and analysis
+    closes the database connection of the thread ahead of a network wait,
+    unless a transaction is open, so that a worker waiting on a slow host 
+    does not hold a connection. The next query opens a new one
     """
-    feed_id = message_data['args'][0]
-    feed = Feed.objects.get(pk=feed_id)
+    if not connection.in_atomic_block:
+        connection.close()
 
-    # mark feed as failed to update and stop updateing it automatically
-    feed.flagged = True
-    feed.save()
+def notify_update_retry(feeds, source, wait):
+    """
+    notifies the owners of feeds that their update failed and is retried
+    in `wait` seconds
+    """
+    notifications = [
+        Notification(feed=feed, owner_id=feed.owner_id, kind=NOTIFICATION_BACKOFF, title='BackOff', message=f'Feed: {feed.id}, {source.link} failed to update, retrying in {wait:0.1f}', is_error=True)
+        for feed in feeds
+    ]
+    Notification.objects.coalesce(notifications)
+    UserCounter.objects.touch([n.owner_id for n in notifications])
+
+def clear_retry_notifications(feeds):
+    """
+    deletes the unread retry notifications of feeds, once their update
+    succeeded or failed for good
+    """
+    Notification.objects.filter(feed__in=feeds, kind=NOTIFICATION_BACKOFF, state=ENTRY_UNREAD).delete()
 
-    notification = Notification(feed=feed, owner=feed.owner, title=exception_data['type'], message=exception_data['message']+f'[Feed: {feed.id}, {feed.link}]', is_error=True)
-    notification.save()
-    print("dramatiq callback: feed update error")
+def notify_update_failure(feeds, title, message):
+    """
+    marks feeds as failed to update, so they are not updated automatically
+    anymore, and notifies their owners
+    """
+    feeds.update(flagged=True)
+    clear_retry_notifications(feeds)
 
+    notifications = [
+        Notification(feed=f, owner_id=f.owner_id, kind=NOTIFICATION_FAILED, title=title, message=message+f'[Feed: {f.id}, {f.link}]', is_error=True)
+        for f in feeds
+    ]
+    Notification.objects.coalesce(notifications)
+    UserCounter.objects.touch([n.owner_id for n in notifications])
 
-@dramatiq.actor
-def feed_update_success(message_data, result):
+def notify_update_success(feeds, modified=True):
+    """
+    marks feeds as not flagged and notifies their owners of the update.
+    If the document was not modified, nothing changed but the flagged 
+    feeds: they are unflagged, without notification
     """
-    A dramatiq callback on successful attempt for a feed update
-    the user will notified by inserting a notification in the db 
+    if not modified:
+        owners = list(feeds.filter(flagged=True).values_list('owner_id', flat=True))
+        if owners:
+            feeds.filter(flagged=True).update(flagged=False)
+            UserCounter.objects.touch(owners)
+        return
+
+    feeds.update(flagged=False)
 
-    marks the feed as not flagged 
+    notifications = [
+        Notification(feed=f, owner_id=f.owner_id, kind=NOTIFICATION_UPDATED, title='FeedUpdated', message=f'Feed: {f.id}, {f.link}, {f.updated_at}]', is_error=False)
+        for f in feeds
+    ]
+    Notification.objects.coalesce(notifications)
+    UserCounter.objects.touch([n.owner_id for n in notifications])
 
-    TODO ??maybe log this also for checking failure/success rates?
+def retry_or_fail(source, feeds, error):
     """
+    records a failed update of a source (saved): the update is sent again 
+    as a delayed message, so that no worker waits for the retry, and the 
+    owners of the feeds are notified of it. Once the source failed 
+    MAX_FEED_UPDATE_RETRIES times in a row, the feeds are flagged and their 
+    owners notified of the failure instead, and the count of failures is 
+    reset: a later update of the flagged feeds is retried again
+
+    Arguments:
+        source      the FeedSource that failed to update
+        feeds       queryset of the feeds of the source
+        error       the exception of the update
+
+    returns True if the update is retried
+    """
+    source.schedule(failed=True)
 
-    feed_id = message_data['args'][0]
-    feed = Feed.objects.get(pk=feed_id)
+    feed = feeds.first()
+    if feed is None or source.failures >= settings.MAX_FEED_UPDATE_RETRIES:
+        source.failures = 0
+        source.save(update_fields=FeedSource.SCHEDULE_FIELDS)
+        notify_update_failure(feeds, error.__class__.__name__, str(error))
+        return False
 
-    feed.flagged = False
-    feed.save()
+    # exponential backoff, with jitter to spread the retries of a host
+    wait = min(settings.FEED_RETRY_BASE_DELAY * 2 ** (source.failures - 1), settings.FEED_RETRY_MAX_DELAY)
+    wait *= random.uniform(0.9, 1.1)
 
-    notification = Notification(feed=feed, owner=feed.owner, title='FeedUpdated', message=f'Feed: {feed.id}, {feed.link}, {feed.updated_at}]', is_error=False)
-    notification.save()
-    print("dramatiq callback: : feed update success")
+    # the scheduler leaves the source to the retry
+    source.next_fetch_at = timezone.now() + datetime.timedelta(seconds=wait)
+    source.save(update_fields=FeedSource.SCHEDULE_FIELDS)
+
+    feed.retry_update(wait)
+    notify_update_retry(feeds, source, wait)
+    tracing.event('retry', level=logging.WARNING, source_id=source.id, link=source.link, failures=source.failures, wait=round(wait, 1))
+    return True
 
-    
 # Exceptions #################################################   
 class FeedError(Exception):
     """
@@ -92,6 +150,334 @@ class FeedError(Exception):
 
 # End: Exceptions #################################################   
 
+# FeedSource #################################################   
+class FeedSource(models.Model):
+    '''
+    A feed url shared by all the users that registered a Feed with that link.
+
+    The document is fetched and parsed once per source and the result 
+    is written to every subscribing Feed
+    '''
+    link = models.URLField(max_length = 200, unique=True)
+
+    # validators of the last fetched document, used for conditional requests
+    etag = models.CharField(max_length=200, null=True, blank=True)
+    last_modified = models.CharField(max_length=50, null=True, blank=True)
+    body_hash = models.CharField(max_length=40, null=True, blank=True)
+
+    # scheduling: when to fetch next, from the ttl (minutes) announced by the 
+    # feed, the observed rate of new entries (per hour) and the failures in a row
+    next_fetch_at = models.DateTimeField(default=timezone.now, db_index=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+    ttl = models.PositiveIntegerField(null=True, blank=True)
+    entry_rate = models.FloatField(null=True, blank=True)
+    failures = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta: 
+        verbose_name = ("Feed Source")
+        verbose_name_plural = ("Feed Sources")
+
+    objects = managers.FeedSourceManager()
+
+    SCHEDULE_FIELDS = ['next_fetch_at', 'fetched_at', 'ttl', 'entry_rate', 'failures']
+
+    def __str__(self):
+        return f'Source: {self.link}'
+
+    def _fetch_feed(self):
+        '''
+        internal method to get feed details from the link of the source
+
+        returns raw feed and entry details as returned by the feedparser library,
+        or (None, None) if the document did not change since the last fetch
+        '''
+        # Request the feed, conditionally if it was fetched before
+        try:
+            with tracing.span('fetch', source_id=self.id, host=metrics.host(self.link)) as fields:
+                result = fetcher.fetch(self.link, etag=self.etag, modified=self.last_modified)
+                fields.update(status=result.status, size=result.size)
+        except fetcher.FetchError as e:
+            raise FeedError('Fetch error %s' % e)
+
+        return self._read_result(result)
+
+    def _read_result(self, result):
+        '''
+        checks the status of a fetcher.FetchResult and parses its document
+
+        returns raw feed and entry details as returned by the feedparser library,
+        or (None, None) if the document did not change since the last fetch.
+        The entries may be a generator (see StreamingParser)
+        '''
+        status = result.status
+
+        # Follow permanent redirection
+        if result.moved and not FeedSource.objects.filter(link=result.url).exists():
+            self.link = result.url
+
+        if status == 304:
+            return None, None
+
+        if status in (200, 302, 307):
+            # same bytes as last time, no need to parse
+            body_hash = result.body_hash
+            if body_hash == self.body_hash:
+                return None, None
+
+            # large documents are parsed one entry at a time
+            if result.size > settings.FEED_STREAM_THRESHOLD:
+                with metrics.parse_seconds.labels('streaming').time(), tracing.span('parse', source_id=self.id, parser='streaming'):
+                    parser = StreamingParser(result.file)
+                feed    = parser.feed
+                entries = parser.entries()
+            else:
+                with metrics.parse_seconds.labels('feedparser').time(), tracing.span('parse', source_id=self.id, parser='feedparser'):
+                    d = feedparser.parse(result.read(), response_headers=result.headers)
+                feed    = d.get('feed', None)
+                entries = d.get('entries', None)
+
+            if (
+                feed is None
+                or 'title' not in feed
+                or 'link' not in feed
+            ):
+                raise FeedError('Feed parsed but with invalid contents')
+
+            self.etag = result.etag
+            self.last_modified = result.modified
+            self.body_hash = body_hash
+
+            return feed, entries
+
+        if status in (404, 500, 502, 503, 504):
+            raise FeedError('Temporary error %s' % status)
+
+        if status == 410:
+            raise FeedError('Feed has gone')
+
+        # Unknown status
+        raise FeedError('Unrecognised HTTP status %s' % status)
+
+
+    def update(self):
+        """
+        fetches and parses the source document once, then writes the feed 
+        details and entries to every subscribing Feed
+
+        the fetch and parse run outside of any transaction, without holding 
+        a database connection, only the writes are in transactions (see _store)
+
+        returns False if the document was not modified since the last update
+        """
+        release_connection()
+        try:
+            rawFeed, entries = self._fetch_feed()
+        except FeedError:
+            metrics.updates.labels('failed').inc()
+            raise
+
+        return self._store(rawFeed, entries)
+
+    def _store(self, rawFeed, entries):
+        """
+        writes a parsed document to the source and all its feeds,
+        and schedules the next fetch of the source
+
+        the feed details and each batch of entries are written in their own 
+        short transaction, the entries of a batch are parsed before it opens.
+        If the update fails half way, the batches already written are kept:
+        the document is read again on the next fetch and its entries are 
+        upserted, the unchanged ones skipped
+
+        returns False if the document was not modified (rawFeed is None)
+        """
+        with tracing.span('store', source_id=self.id) as fields:
+            fields['created'] = self._store_entries(rawFeed, entries)
+            fields['modified'] = rawFeed is not None
+
+        return rawFeed is not None
+
+    def _store_entries(self, rawFeed, entries):
+        """
+        does the work of _store(), returns the number of created entries
+        """
+        # not modified since the last update
+        if rawFeed is None:
+            metrics.updates.labels('not_modified').inc()
+            self.schedule()
+            self.save(update_fields=self.SCHEDULE_FIELDS)
+            return 0
+
+        try:
+            self.ttl = int(rawFeed.get('ttl', None))
+        except (TypeError, ValueError):
+            self.ttl = None
+
+        # Try to find the updated time
+        updated = rawFeed.get(
+            'updated_parsed',
+            rawFeed.get('published_parsed', None),
+        )
+
+        if updated:
+            updated = datetime.datetime.fromtimestamp(
+                time.mktime(updated)
+            )
+
+        feeds = self.feeds.filter(deleted=False)
+        with transaction.atomic():
+            feeds.update(
+                title = rawFeed.get('title', None),
+                subtitle = rawFeed.get('subtitle', None),
+                copyright = rawFeed.get('rights', None),
+                ttl = self.ttl,
+                atomLogo = rawFeed.get('logo', None),
+                pubdate = updated,
+                updated_at = timezone.now(),
+            )
+
+            # parse once for all subscribers, sanitised only if written, in
+            # batches of a fixed size whatever the size of the document
+            feeds = list(feeds)
+        entries = itertools.islice(entries or [], settings.FEED_MAX_ENTRIES)
+
+        # entries every feed would delete right away are not written, they 
+        # would come back on each update otherwise. New entries are unread,
+        # they are all written if the unread entries are kept: the entries 
+        # the job deleted are then left out by reconcile (Feed.pruned_until)
+        max_ages = [feed.retention()[0] for feed in feeds]
+        expired = None
+        if max_ages and None not in max_ages and not settings.ENTRY_RETENTION_KEEP_UNREAD:
+            expired = datetime.datetime.now() - max(max_ages)
+
+        created = 0
+        while True:
+            start = time.perf_counter()
+            batch = list(itertools.islice(entries, settings.ENTRY_STREAM_BATCH_SIZE))
+            if not batch:
+                break
+
+            parsed = [Item.objects.parseFromFeed(raw_entry, sanitize=False) for raw_entry in batch]
+            metrics.entry_parse_seconds.observe(time.perf_counter() - start)
+            if expired is not None:
+                parsed = [entry for entry in parsed if entry.date is None or entry.date >= expired]
+            with transaction.atomic():
+                batch_created, _ = Entry.objects.reconcile(self, feeds, parsed)
+            created += batch_created
+
+        # new entries count once, not once per subscriber
+        feed_count = len(feeds) or 1
+        self.schedule(created=created // feed_count)
+        self.save()
+
+        # bumped once every batch is written: a list read in between is
+        # tagged with the previous version, and read again afterwards
+        UserCounter.objects.touch([feed.owner_id for feed in feeds])
+
+        metrics.updates.labels('updated').inc()
+
+        return created
+
+    def schedule(self, created=0, failed=False):
+        """
+        computes when the source should be fetched next (not saved)
+
+        Arguments:
+            created     number of new entries found by this fetch
+            failed      True if this fetch failed
+        """
+        now = timezone.now()
+
+        if failed:
+            self.failures += 1
+        else:
+            self.failures = 0
+
+            # smoothed rate of new entries per hour
+            if self.fetched_at:
+                hours = max((now - self.fetched_at).total_seconds() / 3600, 1 / 60)
+                rate = created / hours
+                if self.entry_rate is None:
+                    self.entry_rate = rate
+                else:
+                    smoothing = settings.SCHEDULER_RATE_SMOOTHING
+                    self.entry_rate = smoothing * rate + (1 - smoothing) * self.entry_rate
+            self.fetched_at = now
+
+        # wait long enough to expect about one new entry
+        if self.entry_rate is None:
+            interval = settings.SCHEDULER_DEFAULT_INTERVAL
+        elif self.entry_rate > 0:
+            interval = 3600 / self.entry_rate
+        else:
+            interval = settings.SCHEDULER_MAX_INTERVAL
+
+        # but not more often than the feed's time to live
+        if self.ttl:
+            interval = max(interval, self.ttl * 60)
+
+        # and back off from sources that keep failing
+        interval *= 2 ** min(self.failures, 10)
+
+        interval = min(max(interval, settings.SCHEDULER_MIN_INTERVAL), settings.SCHEDULER_MAX_INTERVAL)
+
+        # jitter spreads the sources that have the same interval
+        interval *= random.uniform(0.9, 1.1)
+
+        self.next_fetch_at = now + datetime.timedelta(seconds=interval)
+
+    @dramatiq.actor(max_retries=0, max_age=10000)
+    def _updateSources(pks):
+        """
+        An internal function that updates a batch of sources. The documents 
+        are downloaded concurrently, then parsed and stored one source at a time.
+
+        A source that fails to be fetched is retried later through the update 
+        of one of its feeds, see retry_or_fail(). Any other error flags the 
+        feeds of its source, and the rest of the batch is still updated
+        """
+        sources = list(FeedSource.objects.filter(pk__in=pks))
+        release_connection()
+        with tracing.span('fetch_many', sources=len(sources)):
+            results = fetcher.fetch_many([(s.link, s.etag, s.last_modified) for s in sources])
+
+        updated = []
+        not_modified = []
+        for source, result in zip(sources, results):
+            try:
+                if isinstance(result, fetcher.FetchError):
+                    raise FeedError('Fetch error %s' % result)
+                if isinstance(result, Exception):
+                    raise result
+
+                # parsed outside of any transaction, see _store()
+                if source._store(*source._read_result(result)):
+                    updated.append(source.id)
+                else:
+                    not_modified.append(source.id)
+            except Exception as e:
+                metrics.updates.labels('failed').inc()
+                tracing.event(
+                    'fetch_failed' if isinstance(e, FeedError) else 'update_failed', level=logging.WARNING,
+                    source_id=source.id, link=source.link, error=e.__class__.__name__, detail=str(e),
+                )
+                feeds = Feed.objects.filter(source_id=source.id, deleted=False)
+                if isinstance(e, FeedError):
+                    retry_or_fail(source, feeds, e)
+                else:
+                    source.schedule(failed=True)
+                    source.failures = 0
+                    source.save(update_fields=FeedSource.SCHEDULE_FIELDS)
+                    notify_update_failure(feeds, e.__class__.__name__, str(e))
+
+        notify_update_success(Feed.objects.filter(source_id__in=updated, deleted=False))
+        notify_update_success(Feed.objects.filter(source_id__in=not_modified, deleted=False), modified=False)
+        return
+
+
 # Feed #################################################   
 class Feed(models.Model):
     '''
@@ -117,165 +503,214 @@ class Feed(models.Model):
 
     flagged = models.BooleanField(default=False) 
 
+    # the feed was deleted by its owner, its entries are being deleted in the background
+    deleted = models.BooleanField(default=False)
+
+    # retention of the entries, None for the global settings, 0 to keep all of them
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    retention_max_entries = models.PositiveIntegerField(null=True, blank=True)
+    # the newest date of the entries deleted by the retention job, entries
+    # published up to then are not written again when the source is updated
+    pruned_until = models.DateTimeField(null=True, blank=True)
+
+    # kept up to date with every write of the feed's entries
+    unread_count = models.IntegerField(default=0)
+    entry_count = models.IntegerField(default=0)
+
+    source = models.ForeignKey(FeedSource, related_name='feeds', null=True, on_delete=models.SET_NULL)
+
     owner = models.ForeignKey('auth.User', related_name='feeds', on_delete=models.CASCADE)
 
     class Meta: 
         verbose_name = ("Feed")
         verbose_name_plural = ("Feeds")
         ordering = ('-updated_at',)
-        unique_together = ('link', 'owner')
+        constraints = [
+            # a deleted feed can be followed again while its entries are being deleted
+            models.UniqueConstraint(fields=['link', 'owner'], condition=models.Q(deleted=False), name='feed_unique_link_owner'),
+        ]
+        indexes = [
+            # the feed list of a user, most recently updated first
+            models.Index(fields=['owner', '-updated_at'], name='feed_owner_updated_idx'),
+            # the feeds to update, per source
+            models.Index(fields=['source'], condition=models.Q(flagged=False), name='feed_unflagged_source_idx'),
+        ]
 
     
     objects = managers.FeedManager()
 
+    # never written back by save()
+    UPDATED_FIELDS = ('unread_count', 'entry_count', 'deleted', 'pruned_until')
 
     def __str__(self):
         return f'Nickname: {self.nickname}'
 
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        feed = super(Feed, cls).from_db(db, field_names, values)
+        # remember the stored link to detect a change of source on save
+        feed._db_link = feed.__dict__.get('link', None)
+        return feed
+
     def save(self, *args, **kwargs):
 
         # assure minimum required fields   
         assert self.link
         assert self.nickname
 
+        # share the source of every other feed with the same link
+        attached = self.source_id is None or self.link != getattr(self, '_db_link', self.link)
+        if attached:
+            self.source, _ = FeedSource.objects.get_or_create(link=self.link)
+            self._db_link = self.link
+
+        adding = self._state.adding
+
+        # written with single updates only (counters, deletion), a save must 
+        # not put back the values the feed was loaded with
+        if not adding and not args and 'update_fields' not in kwargs:
+            skipped = set(self.UPDATED_FIELDS) | self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped and field.name not in skipped
+            ]
+
         super(Feed, self).save(*args, **kwargs)
 
         assert self.id > 0
 
+        if adding:
+            UserCounter.objects.get_or_create(user_id=self.owner_id)
+
+        # the items the source was already fetched with
+        if attached:
+            Entry.objects.subscribe(self)
+
+        UserCounter.objects.touch([self.owner_id])
+
         return
 
-    def force_update(self, *args, **kwargs):
+    def retention(self):
         '''
-        force updates a feed using a async call to the _updateFeed method
+        returns (max_age, max_entries) of the feed's entries: a timedelta and 
+        a number, from the feed or the settings, None for no limit
         '''
-        print(f'Forcing update [Feed ID: {self.id}], Nickname: {self.nickname}] ...')
-        self._updateFeed.send_with_options(args=(self.id,), on_failure=feed_update_failure, on_success=feed_update_success)
-        return
+        days = self.retention_days if self.retention_days is not None else settings.ENTRY_RETENTION_DAYS
+        max_entries = self.retention_max_entries if self.retention_max_entries is not None else settings.ENTRY_RETENTION_MAX_ENTRIES
 
-    @backoff.on_exception(backoff.expo, FeedError, max_tries=MAX_FEED_UPDATE_RETRIES, on_backoff=backoff_hdlr)
-    def _fetch_feed(self):
-        '''
-        internal method to get feed details from the link provided in self
+        return (
+            datetime.timedelta(days=days) if days else None,
+            max_entries or None,
+        )
 
-        returns raw feed and entry details as returned by the feedparser library
+    @transaction.atomic
+    def delete_later(self):
         '''
-        # Request and parse the feed
-        link = self.link
-        d = feedparser.parse(link)
-        status  = d.get('status', 200)
-        feed    = d.get('feed', None)
-        entries = d.get('entries', None)
-
-        if status in (200, 302, 304, 307):
-            if (
-                feed is None
-                or 'title' not in feed
-                or 'link' not in feed
-            ):
-                raise FeedError('Feed parsed but with invalid contents')
-            
-            return feed, entries
+        hides the feed at once, its entries are deleted in the background by
+        _deleteFeed, a batch at a time
+        '''
+        Feed.objects.filter(pk=self.pk).update(deleted=True)
+        self.deleted = True
 
-        if status in (404, 500, 502, 503, 504):
-            raise FeedError('Temporary error %s' % status)
+        counts = Feed.objects.filter(pk=self.pk).values_list('unread_count', 'entry_count').first()
+        UserCounter.objects.add_counts({self.owner_id: (-counts[0], -counts[1])})
+        Notification.objects.filter(feed=self).delete()
 
-        # Follow permanent redirection
-        if status == 301:
-            # Avoid circular redirection
-            self.link = d.get('href', self.link)
-            return self._fetch_feed()
+        transaction.on_commit(lambda: self._deleteFeed.send(self.pk))
 
-        if status == 410:
-            raise FeedError('Feed has gone')
+    @dramatiq.actor(max_retries=3)
+    def _deleteFeed(pk):
+        """
+        deletes a feed hidden by delete_later(), after its entries
+        """
+        Entry.objects.delete_batches(Entry.objects.filter(feed_id=pk), counters=False)
+        Feed.objects.filter(pk=pk, deleted=True).delete()
 
-        # Unknown status
-        raise FeedError('Unrecognised HTTP status %s' % status)
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        # the entries go with the feed, take them off the owner's counters
+        counts = Feed.objects.filter(pk=self.pk).values_list('unread_count', 'entry_count').first()
+        if counts:
+            UserCounter.objects.add_counts({self.owner_id: (-counts[0], -counts[1])})
 
+        return super(Feed, self).delete(*args, **kwargs)
+
+    def force_update(self, *args, **kwargs):
+        '''
+        force updates a feed using a async call to the _updateFeed method
+        '''
+        with tracing.span('force_update', feed_id=self.id, source_id=self.source_id):
+            self._updateFeed.send(self.id)
+        return
+
+    def retry_update(self, wait):
+        '''
+        sends the update of the feed again in `wait` seconds, as a delayed 
+        message that does not hold a worker in the meantime
+        '''
+        delay = int(wait * 1000)
+        self._updateFeed.send_with_options(args=(self.id,), delay=delay or None, max_age=delay + 10000)
 
     @dramatiq.actor(max_retries=0, max_age=10000)#, throws=FeedError)
-    @transaction.atomic
     def _updateFeed(pk):
         """
         An internal function that fetches a feed and parses it into the 
         Feed object for the DB
-        """
-        feed = get_object_or_404(Feed, pk=pk)
-
-        rawFeed, entries = feed._fetch_feed() 
 
-        feed.title = rawFeed.get('title', None)
-        feed.subtitle = rawFeed.get('subtitle', None)
-        feed.copyright = rawFeed.get('rights', None)
-        feed.ttl = rawFeed.get('ttl', None)
-        feed.atomLogo = rawFeed.get('logo', None)
-
-        # Try to find the updated time
-        updated = rawFeed.get(
-            'updated_parsed',
-            rawFeed.get('published_parsed', None),
-        )
+        the update is done on the feed's source, so every user following 
+        the same link gets the new entries
 
-        if updated:
-            updated = datetime.datetime.fromtimestamp(
-                time.mktime(updated)
+        the outcome is recorded here, in bulk for all the feeds of the 
+        source, rather than by callback messages: they are unflagged and 
+        their owners notified of the update if the document was modified, 
+        or flagged and notified of the failure. A fetch error is retried 
+        later, see retry_or_fail()
+        """
+        feed = get_object_or_404(Feed, pk=pk)
+        source = feed.source
+        feeds = Feed.objects.filter(source_id=feed.source_id, deleted=False)
+        retried = source.failures > 0
+
+        try:
+            modified = source.update()
+        except Exception as e:
+            # a fetch error is retried, until the source failed too many times
+            if not isinstance(e, FeedError):
+                notify_update_failure(feeds, e.__class__.__name__, str(e))
+            elif retry_or_fail(source, feeds, e):
+                return
+            tracing.event(
+                'update_failed', level=logging.WARNING, feed_id=pk, source_id=feed.source_id,
+                error=e.__class__.__name__, detail=str(e),
             )
+            raise
 
-        feed.pubdate = updated
-
-        super(Feed, feed).save()
-
-        if entries:
-            dbEntriesCreate = []
-            dbEntriesupdate = []
-            for raw_entry in entries:
-                entry = Entry.objects.parseFromFeed(raw_entry)
-                entry.feed = feed
-
-                try:
-                    newEntry = Entry.objects.get(guid=entry.guid, feed=feed)
-                except:
-                    newEntry = None
-
-                
-                if newEntry:
-                    # if it was updated, then mark it as unread, otherwise no need to do anything
-                    if newEntry.date > entry.date:
-                        entry.state = ENTRY_UNREAD
-                        id = newEntry.id
-                        newEntry =  entry
-                        newEntry.id = id
-                        dbEntriesupdate.append(newEntry)
-                else:
-                    dbEntriesCreate.append(entry)
-
-            with transaction.atomic():
-                if len(dbEntriesCreate)>0:
-                    Entry.objects.bulk_create(dbEntriesCreate)
-                if len(dbEntriesupdate)>0:
-                    fields = ['feed', 'state', 'title' , 'content', 'date', 'author', 'url' ,'comments_url']
-                    Entry.objects.bulk_update(dbEntriesupdate, fields)
+        if retried:
+            clear_retry_notifications(feeds)
+        notify_update_success(feeds, modified=modified)
+        tracing.event('update_succeeded', feed_id=pk, source_id=feed.source_id, modified=modified)
 
         return
 
 # Enrty #################################################   
-class Entry(models.Model):
+class Item(models.Model):
     """
-    Represents a feed entry object
+    An entry as published by a source, stored once for all the users that 
+    follow it. Each of them gets an Entry of the item, with their read state
 
-    If creating from a feedparser entry, use Entry.objects.parseFromFeed()
+    If creating from a feedparser entry, use Item.objects.parseFromFeed()
     """
 
-    feed = models.ForeignKey(Feed, related_name='feed', on_delete=models.CASCADE)
-    
-    state = models.IntegerField(default=ENTRY_UNREAD, choices=(
-        (ENTRY_UNREAD,  'Unread'),
-        (ENTRY_READ,    'Read'),
-    ))
+    source = models.ForeignKey(FeedSource, related_name='items', on_delete=models.CASCADE)
 
     # Compulsory data fields
     title = models.TextField(blank=True)
     content = models.TextField(blank=True)
+    excerpt = models.TextField(
+        blank=True,
+        help_text="Beginning of the content as plain text, for summaries",
+    )
     date = models.DateTimeField(
         help_text="When this entry says it was published",
     )
@@ -297,40 +732,130 @@ class Entry(models.Model):
         blank=True,
         help_text="GUID for the entry, according to the feed",
     )
+    content_hash = models.CharField(
+        max_length=40, null=True, blank=True,
+        help_text="Digest of the published title, content, url and author",
+    )
 
     last_updated = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = managers.ItemManager()
+
+    def __unicode__(self):
+        return self.title
+
+    def save(self, *args, **kwargs):
+        # Default the date
+        if self.date is None:
+            self.date = datetime.datetime.now()
+
+        if self.content and not self.excerpt:
+            self.excerpt = Item.objects.excerpt(self.content)
+
+        super(Item, self).save(*args, **kwargs)
+
+    class Meta:
+        unique_together = ['source', 'guid']
+
+
+class Entry(models.Model):
+    """
+    An item of a source in a user's feed, with the user's read state. 
+    
+    The content is read from the item, shared by all the feeds of the 
+    source. Entries are written by Entry.objects.reconcile()
+    """
+
+    feed = models.ForeignKey(Feed, related_name='feed', on_delete=models.CASCADE)
+    item = models.ForeignKey(Item, related_name='entries', on_delete=models.CASCADE)
+    
+    state = models.IntegerField(default=ENTRY_UNREAD, choices=(
+        (ENTRY_UNREAD,  'Unread'),
+        (ENTRY_READ,    'Read'),
+    ))
+
+    # the date of the item, for the indexes of the feed
+    date = models.DateTimeField(
+        help_text="When this entry says it was published",
+    )
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     objects = managers.EntryManager()
     
+    # fields of the entry read from its item
+    CONTENT_FIELDS = ['title', 'content', 'excerpt', 'content_hash', 'author', 'url', 'comments_url', 'guid', 'last_updated']
+
     def __unicode__(self):
-        return self.title
+        return self.item.title
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        entry = super(Entry, cls).from_db(db, field_names, values)
+        # remember the stored state to keep the unread counters on save
+        entry._db_state = entry.__dict__.get('state', None)
+        return entry
         
+    @transaction.atomic
     def save(self, *args, **kwargs):
         # Default the date
         if self.date is None:
-            self.date = datetime.datetime.now()
+            self.date = self.item.date
+
+        unread = int(self.state == ENTRY_UNREAD)
+        if self._state.adding:
+            counts = (unread, 1)
+        else:
+            db_state = getattr(self, '_db_state', self.state)
+            counts = (unread - int(db_state == ENTRY_UNREAD), 0)
         
         # Save
         super(Entry, self).save(*args, **kwargs)
+
+        Feed.objects.add_counts({self.feed_id: counts})
+        if not any(counts):
+            UserCounter.objects.touch(Feed.objects.filter(pk=self.feed_id).values_list('owner_id', flat=True))
+        self._db_state = self.state
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        Feed.objects.add_counts({self.feed_id: (-int(self.state == ENTRY_UNREAD), -1)})
+        return super(Entry, self).delete(*args, **kwargs)
         
     class Meta:
         ordering = ('-updated_at',)
         verbose_name_plural = 'entries'
-        # two users can have the same feed but one migh force update and the other 
-        # wants to keep old version, so make it unique even though it make entries redundant
-        unique_together = ['feed', 'guid']
+        unique_together = ['feed', 'item']
+        indexes = [
+            # the entries of a feed, most recently updated first (the order of the entry list)
+            models.Index(fields=['feed', '-updated_at', '-id'], name='entry_feed_updated_idx'),
+            # only the unread entries of a feed, a small part of all of them
+            models.Index(fields=['feed', '-updated_at', '-id'], condition=models.Q(state=ENTRY_UNREAD), name='entry_unread_feed_idx'),
+            # the entries of a feed by publication date, for the retention
+            models.Index(fields=['feed', '-date', '-id'], name='entry_feed_date_idx'),
+        ]
 
 
 # Notification
 class Notification(models.Model):
     '''
     Notifications for users. Currently used for feed update success/failure events
+
+    Repeated notifications of the same kind for a feed are merged into its
+    unread one, see NotificationManager.coalesce()
     '''
     owner = models.ForeignKey('auth.User', on_delete=models.CASCADE)
     feed = models.ForeignKey(Feed, on_delete=models.CASCADE)
+
+    kind = models.CharField(max_length=20, default=NOTIFICATION_UPDATED, choices=(
+        (NOTIFICATION_UPDATED,  'Updated'),
+        (NOTIFICATION_FAILED,   'Failed'),
+        (NOTIFICATION_BACKOFF,  'Backoff'),
+    ))
+    # number of merged notifications
+    count = models.PositiveIntegerField(default=1)
     
     state = models.IntegerField(default=ENTRY_UNREAD, choices=(
         (ENTRY_UNREAD,  'Unread'),
@@ -348,9 +873,51 @@ class Notification(models.Model):
         verbose_name = ("Notification")
         verbose_name_plural = ("Notifications")
         ordering = ('-updated_at',)
+        indexes = [
+            # the notifications of a user, most recently updated first
+            models.Index(fields=['owner', '-updated_at', '-id'], name='notification_owner_updated_idx'),
+            models.Index(fields=['owner', '-updated_at', '-id'], condition=models.Q(state=ENTRY_UNREAD), name='notification_unread_owner_idx'),
+            # the unread notification to merge a new one into
+            models.Index(fields=['feed', 'kind'], condition=models.Q(state=ENTRY_UNREAD), name='notification_unread_kind_idx'),
+            # the read notifications to prune
+            models.Index(fields=['updated_at'], condition=models.Q(state=ENTRY_READ), name='notification_read_idx'),
+        ]
+
+    objects = managers.NotificationManager()
 
     def __unicode__(self):
         return self.title
 
     def __str__(self):
-        return f'feed: {self.feed}, owner: {self.owner}'
\ No newline at end of file
+        return f'feed: {self.feed}, owner: {self.owner}'
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        super(Notification, self).save(*args, **kwargs)
+        UserCounter.objects.touch([self.owner_id])
+
+
+# User counters #################################################   
+class UserCounter(models.Model):
+    '''
+    Unread and total entry counts over all the feeds of a user, kept up to 
+    date along with the counters of the feeds.
+
+    The version is bumped by every change to the feeds, entries or 
+    notifications of the user, it tags the responses of the list endpoints
+    '''
+    user = models.OneToOneField('auth.User', related_name='counter', on_delete=models.CASCADE)
+
+    unread_count = models.IntegerField(default=0)
+    entry_count = models.IntegerField(default=0)
+
+    version = models.PositiveIntegerField(default=0)
+
+    objects = managers.UserCounterManager()
+
+    class Meta: 
+        verbose_name = ("User Counter")
+        verbose_name_plural = ("User Counters")
+
+    def __str__(self):
+        return f'user: {self.user_id}, unread: {self.unread_count}/{self.entry_count}'
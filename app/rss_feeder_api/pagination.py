@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class UpdatedCursorPagination(CursorPagination):
+    '''
+    Keyset pagination on the most recently updated first.
+
+    Pages are read with a `WHERE updated_at < cursor` on an ordered index
+    instead of an OFFSET, so every page is as fast as the first one. The
+    total number of items is only counted when asked for with ?count=true
+
+    Both columns are descending, so that the (..., -updated_at, -id) indexes
+    give the rows in order without a sort
+    '''
+    ordering = ('-updated_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+
+        count = request.query_params.get('count', None)
+        if count == 'true' or count == 'True':
+            self.count = queryset.count()
+
+        return super(UpdatedCursorPagination, self).paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        page = OrderedDict()
+        if self.count is not None:
+            page['count'] = self.count
+        page['next'] = self.get_next_link()
+        page['previous'] = self.get_previous_link()
+        page['results'] = data
+
+        return Response(page)
+
+
+class RankCursorPagination(UpdatedCursorPagination):
+    '''
+    Keyset pagination on the best search matches first, on the `rank`
+    annotation of rss_feeder_api.search
+    '''
+    ordering = ('-rank', '-id')
@@ -0,0 +1,85 @@
+'''
+Full-text search over the entries, on the items they share.
+
+The index is maintained by the database itself, in the same statement as
+the item writes (the INSERT ... ON CONFLICT of a feed update), so ingest
+needs no extra round trip:
+
+    postgresql  a generated tsvector column, weighting the title over the
+                content, with a GIN index (html tags are skipped by the parser)
+    sqlite      an FTS5 table on the title and content, synced by triggers
+
+installed by the migrations 0017 (on the entries) and 0020 (moved to the items).
+'''
+
+from django.db import connections, models
+from django.db.models.expressions import RawSQL
+
+
+# text search configuration of postgres
+SEARCH_CONFIG = 'english'
+
+# the table holding the title and content, shared by the entries of a source
+SEARCH_TABLE = 'rss_feeder_api_item'
+
+
+class SearchUnavailable(Exception):
+    """
+    The database has no full-text search (neither postgres nor sqlite)
+    """
+    pass
+
+
+def _fts5_query(query):
+    '''
+    every word of the query as a quoted fts5 string, so that user input can
+    not be read as fts5 syntax. Words are all required, like on postgres
+    '''
+    return ' '.join('"%s"' % word.replace('"', '""') for word in query.split())
+
+
+def search_entries(entries, query):
+    '''
+    Narrows a queryset of entries down to the ones matching a search query,
+    annotated with their `rank` (higher is better)
+
+    Arguments:
+        entries     a queryset of entries, already scoped to a user
+        query       the words to search for, as typed by the user
+
+    Raises SearchUnavailable on other databases
+    '''
+    vendor = connections[entries.db].vendor
+    table = SEARCH_TABLE
+
+    # the entries are matched on their item, with a subquery on the item
+    # table whatever the joins of the queryset
+    if vendor == 'postgresql':
+        tsquery = 'websearch_to_tsquery(%s, %s)'
+        params = (SEARCH_CONFIG, query)
+        matches = RawSQL(
+            '"rss_feeder_api_entry"."item_id" IN (SELECT id FROM {table} WHERE search_vector @@ {tsquery})'.format(table=table, tsquery=tsquery),
+            params, output_field=models.BooleanField(),
+        )
+        rank = RawSQL(
+            '(SELECT ts_rank(search_vector, {tsquery}) FROM {table} WHERE id = "rss_feeder_api_entry"."item_id")'.format(table=table, tsquery=tsquery),
+            params, output_field=models.FloatField(),
+        )
+
+    elif vendor == 'sqlite':
+        params = (_fts5_query(query),)
+        matches = RawSQL(
+            '"rss_feeder_api_entry"."item_id" IN (SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH %s)'.format(table=table),
+            params, output_field=models.BooleanField(),
+        )
+        # bm25 is lower for better matches
+        rank = RawSQL(
+            '(SELECT -bm25({table}_fts) FROM {table}_fts '
+            'WHERE {table}_fts MATCH %s AND rowid = "rss_feeder_api_entry"."item_id")'.format(table=table),
+            params, output_field=models.FloatField(),
+        )
+
+    else:
+        raise SearchUnavailable('Full-text search is not supported on %s' % vendor)
+
+    return entries.filter(matches).annotate(rank=rank)
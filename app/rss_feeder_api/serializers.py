@@ -14,16 +14,52 @@ class UserSerializer(serializers.ModelSerializer):
 
 class FeedSerializer(serializers.ModelSerializer):
     owner = serializers.ReadOnlyField(source='owner.username')
+    # null for the global retention, 0 to keep all the entries
+    retention_days = serializers.IntegerField(min_value=0, allow_null=True, required=False)
+    retention_max_entries = serializers.IntegerField(min_value=0, allow_null=True, required=False)
 
     class Meta:
         model = Feed
         fields = '__all__'
+        read_only_fields = ['source', 'unread_count', 'entry_count', 'deleted', 'pruned_until']
         ordering = ['-updated_at']
 
 class EntrySerializer(serializers.ModelSerializer):
+    '''
+    An entry with the content of its item, as a single object.
+
+    Takes an optional `fields` argument, the names of the only fields to send
+    '''
+    title = serializers.CharField(source='item.title', read_only=True)
+    content = serializers.CharField(source='item.content', read_only=True)
+    excerpt = serializers.CharField(source='item.excerpt', read_only=True)
+    author = serializers.CharField(source='item.author', read_only=True)
+    url = serializers.CharField(source='item.url', read_only=True)
+    comments_url = serializers.CharField(source='item.comments_url', read_only=True)
+    guid = serializers.CharField(source='item.guid', read_only=True)
+    content_hash = serializers.CharField(source='item.content_hash', read_only=True)
+    last_updated = serializers.DateTimeField(source='item.last_updated', read_only=True)
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(EntrySerializer, self).__init__(*args, **kwargs)
+
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     class Meta:
         model = Entry
-        fields = '__all__'
+        fields = ['id', 'feed', 'state', 'title', 'content', 'excerpt', 'date', 'author', 'url', 'comments_url', 'guid', 'content_hash', 'last_updated', 'created_at', 'updated_at']
+        ordering = ['-last_updated']
+
+class EntrySummarySerializer(EntrySerializer):
+    '''
+    An entry without its content, for lists
+    '''
+    class Meta:
+        model = Entry
+        fields = ['id', 'feed', 'state', 'title', 'excerpt', 'date', 'author', 'url', 'updated_at']
         ordering = ['-last_updated']
 
 class NotificationSerializer(serializers.ModelSerializer):
@@ -31,3 +67,13 @@ class NotificationSerializer(serializers.ModelSerializer):
         model = Notification
         fields = '__all__'
         ordering = ['-created_at']
+
+class MarkStateSerializer(serializers.Serializer):
+    '''
+    The items to mark read/unread at once. Every condition given must match,
+    with none all the items of the user are marked
+    '''
+    feed_id = serializers.IntegerField(required=False)
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=500)
+    before = serializers.DateTimeField(required=False, help_text="only the items last updated at or before this time")
+    read = serializers.BooleanField(default=True)
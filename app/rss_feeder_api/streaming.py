@@ -0,0 +1,201 @@
+import datetime
+import email.utils
+
+from xml.etree import ElementTree
+
+
+# elements holding one entry, and the elements whose children describe the feed
+ENTRY_TAGS = ('item', 'entry')
+FEED_TAGS = ('channel', 'feed')
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _text(element):
+    return (element.text or '').strip()
+
+
+def _inner(element):
+    '''
+    the text of an element, including its markup if it has child elements
+    (atom xhtml content)
+    '''
+    if len(element) == 0:
+        return _text(element)
+
+    # serialise as plain html, without the xhtml namespace
+    for child in element.iter():
+        child.tag = _local(child.tag)
+    return (element.text or '') + ''.join(
+        ElementTree.tostring(child, encoding='unicode') for child in element
+    )
+
+
+def _date(value):
+    '''
+    parses an RFC 822 (rss) or ISO 8601 (atom) date into a utc struct_time,
+    like feedparser does. Returns None if the date can not be read
+    '''
+    value = (value or '').strip()
+    if not value:
+        return None
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        try:
+            date = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc)
+    return date.utctimetuple()
+
+
+def _link(element):
+    '''
+    the url of an rss <link> or of an atom <link rel="alternate"/>
+    '''
+    href = element.get('href', None)
+    if href is None:
+        return _text(element)
+    if element.get('rel', 'alternate') == 'alternate':
+        return href
+    return None
+
+
+def _entry(element):
+    '''
+    returns a dict of an item/entry element with the keys of a feedparser entry
+    '''
+    raw = {}
+    for child in element:
+        name = _local(child.tag)
+
+        if name == 'title':
+            raw['title'] = _text(child)
+        elif name == 'link':
+            link = _link(child)
+            if link:
+                raw['link'] = link
+        elif name in ('guid', 'id'):
+            raw['guid'] = _text(child)
+        elif name in ('description', 'summary'):
+            raw['description'] = _inner(child)
+        elif name in ('encoded', 'content'):
+            raw['content'] = [{'value': _inner(child)}]
+        elif name in ('author', 'creator'):
+            author = child.find('{*}name')
+            raw['author'] = _text(author if author is not None else child)
+        elif name == 'comments':
+            raw['comments'] = _text(child)
+        elif name in ('updated', 'modified'):
+            date = _date(child.text)
+            if date:
+                raw['updated_parsed'] = date
+        elif name in ('pubDate', 'published', 'issued', 'date'):
+            date = _date(child.text)
+            if date:
+                raw['published_parsed'] = date
+
+    return raw
+
+
+def _describe(feed, element):
+    '''
+    adds a child element of the channel/feed to the feedparser-like feed dict
+    '''
+    name = _local(element.tag)
+
+    if name == 'title':
+        feed['title'] = _text(element)
+    elif name == 'link':
+        link = _link(element)
+        if link:
+            feed['link'] = link
+    elif name in ('description', 'subtitle', 'tagline'):
+        feed['subtitle'] = _text(element)
+    elif name in ('rights', 'copyright'):
+        feed['rights'] = _text(element)
+    elif name == 'ttl':
+        feed['ttl'] = _text(element)
+    elif name == 'logo':
+        feed['logo'] = _text(element)
+    elif name in ('updated', 'lastBuildDate'):
+        date = _date(element.text)
+        if date:
+            feed['updated_parsed'] = date
+    elif name in ('pubDate', 'published'):
+        date = _date(element.text)
+        if date:
+            feed['published_parsed'] = date
+
+
+class StreamingParser(object):
+    '''
+    Parses a large rss/atom document one entry at a time, so that memory
+    stays flat whatever the size of the document.
+
+    The feed details are read on creation, up to the first entry, then
+    entries() yields feedparser-like entry dicts. Every entry element is
+    dropped from the tree once it was read.
+
+        parser = StreamingParser(file)
+        parser.feed         the feed details (title, link, subtitle...)
+        parser.entries()    generator of entries
+    '''
+    def __init__(self, file):
+        self._events = ElementTree.iterparse(file, events=('start', 'end'))
+        self._stack = []
+        self._depth = 0
+        self.feed = {}
+
+        try:
+            self._read_feed()
+        except ElementTree.ParseError:
+            pass
+
+    def _read_feed(self):
+        for event, element in self._events:
+            if event == 'start':
+                self._stack.append(element)
+                if _local(element.tag) in ENTRY_TAGS:
+                    self._depth = 1
+                    return
+                continue
+
+            self._stack.pop()
+            if self._stack and _local(self._stack[-1].tag) in FEED_TAGS:
+                _describe(self.feed, element)
+
+    def entries(self):
+        if not self._depth:
+            return
+
+        try:
+            for event, element in self._events:
+                is_entry = _local(element.tag) in ENTRY_TAGS
+
+                if event == 'start':
+                    self._stack.append(element)
+                    if is_entry:
+                        self._depth += 1
+                    continue
+
+                self._stack.pop()
+                if not is_entry:
+                    continue
+
+                self._depth -= 1
+                if self._depth == 0:
+                    yield _entry(element)
+
+                    # forget the entry to keep the tree small
+                    element.clear()
+                    if self._stack:
+                        self._stack[-1].remove(element)
+        except ElementTree.ParseError:
+            return
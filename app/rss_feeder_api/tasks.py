@@ -1,14 +1,110 @@
+import datetime
+import itertools
+import time
+
+from django.utils import timezone
+
 from rss_feeder_api.celery import app
 
-from rss_feeder_api.models import Feed
+from rss_feeder_api.models import Entry, Feed, FeedSource, Item, Notification
+from rss_feeder_api import tracing
+
+from rss_feeder import settings
+
+@app.task
+def dispatch_due_sources():
+    with tracing.span('dispatch_due_sources') as fields:
+        fields['sources'] = dispatchDueSources()
+
+@app.task
+def prune_notifications():
+    with tracing.span('prune_notifications') as fields:
+        fields['deleted'] = pruneNotifications()
 
 @app.task
-def my_scheduled_job():
-    print("cron job")
-    updateAllFeeds()
+def prune_entries():
+    with tracing.span('prune_entries') as fields:
+        fields['deleted'] = pruneEntries()
 
 def updateAllFeeds():
-    feeds = Feed.objects.filter(flagged=False)
-    for feed in feeds:
-        feed.force_update()
-    print("Done!")
\ No newline at end of file
+    """
+    Sends an update of every source with at least one unflagged feed.
+
+    Only the source ids are read, streamed from the database in chunks, and
+    each batch of FEED_UPDATE_BATCH_SIZE ids is sent as a single message 
+    (its sources are then fetched concurrently by the worker)
+
+    returns (number of messages sent, number of sources, seconds spent)
+    """
+    start = time.monotonic()
+
+    batch_size = settings.FEED_UPDATE_BATCH_SIZE
+    pks = FeedSource.objects.followed().order_by().values_list('id', flat=True).iterator(chunk_size=batch_size * 10)
+
+    messages = sources = 0
+    while True:
+        batch = list(itertools.islice(pks, batch_size))
+        if not batch:
+            break
+
+        FeedSource._updateSources.send(batch)
+        messages += 1
+        sources += len(batch)
+
+    elapsed = time.monotonic() - start
+    tracing.event('dispatched', sources=sources, messages=messages, elapsed=round(elapsed, 3))
+    return messages, sources, elapsed
+
+def dispatchDueSources():
+    """
+    Sends the updates of the sources that are due, in small batches spread
+    evenly over the scheduler tick. The next fetch of a dispatched source is
+    pushed back so that the following ticks skip it while it waits in the queue,
+    its update then schedules the real next fetch.
+
+    returns the number of dispatched sources
+    """
+    now = timezone.now()
+    pks = list(FeedSource.objects.due(now).values_list('id', flat=True)[:settings.SCHEDULER_MAX_DISPATCH])
+
+    batch_size = settings.SCHEDULER_BATCH_SIZE
+    batches = [pks[i:i + batch_size] for i in range(0, len(pks), batch_size)]
+    claimed_until = now + datetime.timedelta(seconds=settings.SCHEDULER_CLAIM_TIMEOUT)
+
+    for i, batch in enumerate(batches):
+        FeedSource.objects.filter(pk__in=batch).update(next_fetch_at=claimed_until)
+
+        delay = int(i * settings.SCHEDULER_TICK * 1000 / len(batches))
+        FeedSource._updateSources.send_with_options(args=(batch,), delay=delay or None, max_age=delay + 10000)
+
+    return len(pks)
+
+def pruneNotifications():
+    """
+    Deletes the read notifications not updated for NOTIFICATION_RETENTION_DAYS,
+    in batches of NOTIFICATION_PRUNE_BATCH_SIZE
+
+    returns the number of deleted notifications
+    """
+    before = timezone.now() - datetime.timedelta(days=settings.NOTIFICATION_RETENTION_DAYS)
+    deleted = Notification.objects.prune(before)
+    return deleted
+
+def pruneEntries():
+    """
+    Deletes the entries past the retention of their feed (its own or 
+    ENTRY_RETENTION_DAYS / ENTRY_RETENTION_MAX_ENTRIES), a feed at a time.
+    Unread entries are kept if ENTRY_RETENTION_KEEP_UNREAD. The items left 
+    without entries (pruned or of deleted feeds) are deleted after
+
+    returns the number of deleted entries
+    """
+    deleted = 0
+    for feed in Feed.objects.filter(deleted=False).only('id', 'retention_days', 'retention_max_entries').iterator():
+        max_age, max_entries = feed.retention()
+        deleted += Entry.objects.prune(feed, max_age, max_entries, keep_unread=settings.ENTRY_RETENTION_KEEP_UNREAD)
+
+    items = Item.objects.prune()
+
+    tracing.event('pruned', entries=deleted, items=items)
+    return deleted
@@ -1,6 +1,7 @@
 from django.test import TestCase
 
-from rss_feeder_api.models import Feed, Entry, FeedError, Notification
+from rss_feeder_api.models import Feed, FeedSource, Entry, Item, FeedError, Notification, UserCounter
+from rss_feeder_api.constants import ENTRY_UNREAD, ENTRY_READ
 from django.shortcuts import get_object_or_404
 
 from rest_framework import status
@@ -9,6 +10,11 @@ from rest_framework import status
 import pytest
 import time
 import uuid
+import datetime
+
+from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 # Create your tests here.
 from django.contrib.auth.models import User
@@ -22,6 +28,9 @@ import json
 
 from dramatiq import Worker
 from rss_feeder_api import broker
+from rss_feeder_api.sanitizer import Sanitizer, sanitizer
+from rss_feeder_api import fetcher
+from rss_feeder import settings
 
 from rest_framework.test import APIClient
 
@@ -29,10 +38,80 @@ from rest_framework.test import APIClient
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
 ########################
 ## Fixtures ############
 ########################
 
+def make_rss(n=3, title='Local test feed'):
+   items = ''.join(
+      f'<item><title>Item {i}</title><link>http://localhost/item/{i}</link>'
+      f'<guid>item-{i}</guid><description>&lt;p&gt;Body of item {i}&lt;/p&gt;</description>'
+      f'<pubDate>Mon, 0{i % 9 + 1} Jun 2020 10:00:00 GMT</pubDate></item>'
+      for i in range(n)
+   )
+   return (
+      f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+      f'<title>{title}</title><link>http://localhost/</link><description>test</description>'
+      f'{items}</channel></rss>'
+   ).encode('utf-8')
+
+def make_entry(feed, guid, state=ENTRY_UNREAD, date=None, **content):
+   '''
+   an entry of feed, with its item on the source of the feed
+   '''
+   item = Item.objects.create(source=feed.source, guid=guid, date=date, **content)
+   return Entry.objects.create(feed=feed, item=item, state=state)
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+   # path -> {'body': bytes, 'etag': str or None}
+   documents = {}
+   # (path, status) of every served request
+   served = []
+
+   def do_GET(self):
+      document = self.documents.get(self.path, None)
+      if document is None:
+         status, body, etag = 404, b'', None
+      else:
+         body, etag = document['body'], document.get('etag', None)
+         status = 304 if etag and self.headers.get('If-None-Match') == etag else 200
+
+      self.served.append((self.path, status))
+      self.send_response(status)
+      if etag:
+         self.send_header('ETag', etag)
+      self.send_header('Content-Type', 'application/rss+xml')
+      self.send_header('Content-Length', str(len(body) if status == 200 else 0))
+      self.end_headers()
+      if status == 200:
+         self.wfile.write(body)
+
+   def log_message(self, *args):
+      pass
+
+@pytest.fixture
+def feed_server():
+   '''
+   serves feed documents from FeedRequestHandler.documents on localhost
+   yields the base url of the server
+   '''
+   FeedRequestHandler.documents = {}
+   FeedRequestHandler.served = []
+   server = HTTPServer(('127.0.0.1', 0), FeedRequestHandler)
+   thread = threading.Thread(target=server.serve_forever, daemon=True)
+   thread.start()
+   yield f'http://127.0.0.1:{server.server_port}'
+   server.shutdown()
+   server.server_close()
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+   # failed updates are retried after 0.1s, 0.2s...
+   monkeypatch.setattr(settings, 'FEED_RETRY_BASE_DELAY', 0.1)
+
 @pytest.fixture
 def broker():
     broker = dramatiq.get_broker()
@@ -44,6 +123,9 @@ def worker(broker):
     worker = dramatiq.Worker(broker, worker_timeout=100)
     worker.start()
     yield worker
+    # a delayed retry the stopped worker had taken would never be done, and
+    # block the join of the next test
+    broker.join('default')
     worker.stop()
 
 @pytest.fixture
@@ -219,22 +301,22 @@ def test_get_feed(auto_login_user):
 def test_get_read_unread_entries(create_user_with_updated_feed):
   user, feed, client = create_user_with_updated_feed()
   url = reverse('all-entries-list')
-  response = client.get(url+"?read=true")
+  response = client.get(url+"?count=true&read=true")
   assert response.data['count'] == 0, "read entries exist, they shldnt"
 
-  response = client.get(url+"?read=false")
+  response = client.get(url+"?count=true&read=false")
   assert response.data['count'] > 0, "entries arent unread"
 
-  response = client.get(url+"?feed_id=2456532&read=false")
+  response = client.get(url+"?count=true&feed_id=2456532&read=false")
   assert response.data['count'] == 0, "unread entries not filtered by feed id"
 
-  response = client.get(url+"?feed_id=24213211&read=true")
+  response = client.get(url+"?count=true&feed_id=24213211&read=true")
   assert response.data['count'] == 0, "read entries not filtered by feed id"
 
-  response = client.get(url+f'?feed_id={feed.id}&read=true')
+  response = client.get(url+f'?count=true&feed_id={feed.id}&read=true')
   assert response.data['count'] == 0, "entries filtered by correct feed id but not by read status"
   
-  response = client.get(url+f'?feed_id={feed.id}&read=false')
+  response = client.get(url+f'?count=true&feed_id={feed.id}&read=false')
   assert response.data['count'] > 0, "entries filtered by correct feed id but not by unread status"
 
 
@@ -242,7 +324,7 @@ def test_get_read_unread_entries(create_user_with_updated_feed):
 def test_patch_entry_state(create_user_with_updated_feed):
   user, feed, client = create_user_with_updated_feed()
   url = reverse('all-entries-list')
-  response = client.get(url+"?read=false")
+  response = client.get(url+"?count=true&read=false")
   assert response.data['count'] > 0, "read entries exist, they shldnt"
 
   url_detail = reverse('entry-detail-detail', kwargs={'pk':response.data['results'][0]['id']})
@@ -251,7 +333,7 @@ def test_patch_entry_state(create_user_with_updated_feed):
   response = client.get(url_detail)
   assert response.data['state']==1, "state not read"
 
-  response = client.get(url+"?read=true")
+  response = client.get(url+"?count=true&read=true")
   print(response.data)
   assert response.data['count'] == 1, "entry not patched "
 
@@ -271,6 +353,26 @@ def test_patch_feed_follow(create_user_with_updated_feed):
   response = client.get(url+"?follow=false")
   print(response.data)
   assert response.data['count'] == 1, "no unfollowed feeds "
+
+@pytest.mark.django_db(transaction=True)
+def test_patch_feed_retention(auto_login_user):
+  client, user = auto_login_user()
+  feed = Feed.objects.create(link="https://www.nu.nl/rss/Algemeen", owner=user, nickname="test")
+  url_detail = reverse('feeds-detail-detail', kwargs={'pk': feed.id})
+
+  response = client.patch(url_detail, {'retention_days': 7, 'retention_max_entries': 0}, content_type='application/json')
+  assert response.status_code == 200
+  assert response.data['retention_days'] == 7
+  assert response.data['retention_max_entries'] == 0
+
+  response = client.patch(url_detail, {'retention_days': -1, 'retention_max_entries': 'all'}, content_type='application/json')
+  assert response.status_code == 400
+  assert set(response.data) == {'retention_days', 'retention_max_entries'}
+
+  response = client.patch(url_detail, {'retention_days': None}, content_type='application/json')
+  assert response.status_code == 200
+  feed.refresh_from_db()
+  assert (feed.retention_days, feed.retention_max_entries) == (None, 0)
   
 ########################
 ## Unit Tests ##########
@@ -405,22 +507,48 @@ def test_register_and_update_invalid_feed(broker, worker):
     assert Entry.objects.count() == 0
 
 @pytest.mark.django_db(transaction=True)
-def test_backoff(broker, worker):
-    print()
+def test_backoff(feed_server, broker):
     user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
     assert User.objects.count() == 1
 
-    feed = Feed.objects.create(link="https://www.nu.nl/rss/AAAAAlgemeen", owner=user, nickname="test")
+    feed = Feed.objects.create(link=feed_server+'/missing', owner=user, nickname="test")
 
-    try:
-      feed._fetch_feed()
-    except:
-      pass
-    
-    assert Notification.objects.count() == 2, f'notification count error  {Notification.objects.count()}'
-    notification = Notification.objects.all()
-    assert notification[0].title == "BackOff" 
-    assert notification[1].title == "BackOff" 
+    # the failed update is sent again as a delayed message, without waiting
+    start = time.monotonic()
+    Feed._updateFeed(feed.id)
+    assert time.monotonic() - start < 1
+
+    source = FeedSource.objects.get(pk=feed.source_id)
+    assert source.failures == 1
+    assert source.next_fetch_at > timezone.now()
+
+    message = json.loads(broker.queues['default.DQ'].get_nowait())
+    broker.queues['default.DQ'].task_done()
+    assert message['args'] == [feed.id]
+    assert message['options']['eta'] > message['message_timestamp']
+
+    Feed._updateFeed(feed.id)
+    assert FeedSource.objects.get(pk=feed.source_id).failures == 2
+
+    # the two back offs are merged into one notification
+    assert Notification.objects.count() == 1, f'notification count error  {Notification.objects.count()}'
+    notification = Notification.objects.get()
+    assert notification.title == "BackOff" 
+    assert notification.count == 2
+
+    # the last retry fails for good, the back off notification is replaced
+    with pytest.raises(FeedError):
+        Feed._updateFeed(feed.id)
+
+    assert Feed.objects.get(pk=feed.id).flagged
+    assert list(Notification.objects.values_list('title', flat=True)) == ['FeedError']
+    assert broker.queues['default.DQ'].qsize() == 1
+    assert FeedSource.objects.get(pk=feed.source_id).failures == 0
+
+    # updated again by its owner, the flagged feed is retried again
+    Feed._updateFeed(feed.id)
+    assert FeedSource.objects.get(pk=feed.source_id).failures == 1
+    assert broker.queues['default.DQ'].qsize() == 2
     
     assert Feed.objects.count() == 1
     assert Entry.objects.count() == 0
@@ -480,4 +608,1041 @@ def test_async_fetch_with_failed_notification_and_retry_with_success(broker, wor
     count = Notification.objects.count()
     assert  count == 2, f'notification count {count}'
     notification = Notification.objects.all()
-    assert notification[0].title == "FeedUpdated" 
\ No newline at end of file
+    assert notification[0].title == "FeedUpdated" 
+
+@pytest.mark.django_db(transaction=True)
+def test_update_not_modified_with_etag(feed_server):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(), 'etag': '"v1"'}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+
+    feed = Feed.objects.get(pk=feed.id)
+    assert feed.source.etag == '"v1"'
+    assert Entry.objects.count() == 3
+    updated_at = feed.updated_at
+    version = UserCounter.objects.get(user=user).version
+    notifications = list(Notification.objects.values_list('id', 'count', 'updated_at'))
+
+    feed._updateFeed(feed.id)
+    FeedSource._updateSources([feed.source_id])
+
+    assert FeedRequestHandler.served[-2:] == [('/rss', 304), ('/rss', 304)]
+    assert Feed.objects.get(pk=feed.id).updated_at == updated_at, "feed saved although not modified"
+    assert Entry.objects.count() == 3
+    assert UserCounter.objects.get(user=user).version == version, "version bumped although not modified"
+    assert list(Notification.objects.values_list('id', 'count', 'updated_at')) == notifications
+
+    # a flagged feed is still unflagged
+    Feed.objects.filter(pk=feed.id).update(flagged=True)
+    feed._updateFeed(feed.id)
+    assert not Feed.objects.get(pk=feed.id).flagged
+    assert UserCounter.objects.get(user=user).version > version
+
+@pytest.mark.django_db(transaction=True)
+def test_update_not_modified_with_body_hash(feed_server):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+    updated_at = Feed.objects.get(pk=feed.id).updated_at
+
+    feed._updateFeed(feed.id)
+
+    assert FeedRequestHandler.served[-1] == ('/rss', 200)
+    assert Feed.objects.get(pk=feed.id).updated_at == updated_at, "feed saved although body did not change"
+
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(n=4)}
+    feed._updateFeed(feed.id)
+
+    assert Entry.objects.count() == 4
+
+@pytest.mark.django_db(transaction=True)
+def test_update_fans_out_to_all_subscribers(feed_server):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    user2 = User.objects.create_user('john2', 'lennon2@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed2 = Feed.objects.create(link=feed_server+'/rss', owner=user2, nickname="test")
+    assert feed.source_id == feed2.source_id
+
+    feed._updateFeed(feed.id)
+
+    assert len(FeedRequestHandler.served) == 1, "source fetched more than once"
+    assert Entry.objects.filter(feed=feed).count() == 3
+    assert Entry.objects.filter(feed=feed2).count() == 3
+    assert Feed.objects.get(pk=feed2.id).title == 'Local test feed'
+
+    feed2.link = feed_server+'/other'
+    feed2.save()
+    assert Feed.objects.get(pk=feed2.id).source_id != feed.source_id, "source not changed with the link"
+
+@pytest.mark.django_db(transaction=True)
+def test_subscribe_to_fetched_source(feed_server):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    user2 = User.objects.create_user('john2', 'lennon2@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(), 'etag': '"v1"'}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+
+    # subscribed after the source was fetched, the next fetch is not modified
+    feed2 = Feed.objects.create(link=feed_server+'/rss', owner=user2, nickname="test")
+    assert Entry.objects.filter(feed=feed2, state=ENTRY_UNREAD).count() == 3
+
+    feed2._updateFeed(feed2.id)
+    assert FeedRequestHandler.served[-1] == ('/rss', 304)
+    assert Entry.objects.filter(feed=feed2).count() == 3
+
+    feed2 = Feed.objects.get(pk=feed2.id)
+    assert (feed2.unread_count, feed2.entry_count) == (3, 3)
+    counter = UserCounter.objects.get(user=user2)
+    assert (counter.unread_count, counter.entry_count) == (3, 3)
+
+    # moved to the source of another link
+    FeedRequestHandler.documents['/other'] = {'body': make_rss(n=2)}
+    feed3 = Feed.objects.create(link=feed_server+'/other', owner=user, nickname="other")
+    feed3._updateFeed(feed3.id)
+    feed2.link = feed_server+'/other'
+    feed2.save()
+    assert Entry.objects.filter(feed=feed2).count() == 5
+    assert Feed.objects.get(pk=feed2.id).unread_count == 5
+
+@pytest.mark.django_db(transaction=True)
+def test_update_sources_batch(feed_server, broker):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/a'] = {'body': make_rss(n=2)}
+    FeedRequestHandler.documents['/b'] = {'body': make_rss(n=3)}
+
+    feed_a = Feed.objects.create(link=feed_server+'/a', owner=user, nickname="a")
+    feed_b = Feed.objects.create(link=feed_server+'/b', owner=user, nickname="b")
+    feed_c = Feed.objects.create(link=feed_server+'/missing', owner=user, nickname="c")
+
+    FeedSource._updateSources(list(FeedSource.objects.values_list('id', flat=True)))
+
+    assert Entry.objects.filter(feed=feed_a).count() == 2
+    assert Entry.objects.filter(feed=feed_b).count() == 3
+    assert Notification.objects.filter(title='FeedUpdated').count() == 2
+
+    # the failed source is retried later through the single feed update
+    message = broker.queues['default.DQ'].get_nowait()
+    broker.queues['default.DQ'].task_done()
+    assert json.loads(message)['args'] == [feed_c.id]
+
+@pytest.mark.django_db(transaction=True)
+def test_update_sources_batch_unexpected_error(feed_server, broker, monkeypatch):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/a'] = {'body': make_rss(n=2)}
+    FeedRequestHandler.documents['/b'] = {'body': make_rss(n=3)}
+
+    feed_a = Feed.objects.create(link=feed_server+'/a', owner=user, nickname="a")
+    feed_b = Feed.objects.create(link=feed_server+'/b', owner=user, nickname="b")
+
+    read_result = FeedSource._read_result
+    def broken_read_result(self, result):
+        if self.link.endswith('/a'):
+            raise ValueError('broken document')
+        return read_result(self, result)
+    monkeypatch.setattr(FeedSource, '_read_result', broken_read_result)
+
+    FeedSource._updateSources(list(FeedSource.objects.values_list('id', flat=True)))
+
+    # the rest of the batch is updated
+    assert Entry.objects.filter(feed=feed_b).count() == 3
+    assert Notification.objects.filter(feed=feed_b, title='FeedUpdated').count() == 1
+
+    # the feed of the broken source is flagged, not retried
+    assert Feed.objects.get(pk=feed_a.id).flagged
+    assert Notification.objects.filter(feed=feed_a, title='ValueError').count() == 1
+    source = FeedSource.objects.get(pk=feed_a.source_id)
+    assert source.failures == 0
+    assert source.next_fetch_at > timezone.now()
+    assert broker.queues['default.DQ'].qsize() == 0
+
+@pytest.mark.django_db(transaction=True)
+def test_update_upserts_changed_entries(feed_server, django_assert_max_num_queries):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+    Entry.objects.filter(feed=feed).update(state=1)
+
+    # item 0 is republished with a newer date and a new title
+    body = make_rss().replace(b'<title>Item 0</title>', b'<title>Item 0 fixed</title>')
+    body = body.replace(b'Mon, 01 Jun 2020', b'Tue, 02 Jun 2020', 1)
+    FeedRequestHandler.documents['/rss'] = {'body': body}
+
+    # with the update of the feed's and the owner's counters and version, 
+    # the item is written then the entries of the feeds, and the outcome
+    # is notified (5 queries that were in a callback message before). The
+    # feed details and the batch of entries are written in two transactions
+    with django_assert_max_num_queries(19):
+        feed._updateFeed(feed.id)
+
+    assert Entry.objects.filter(feed=feed).count() == 3
+    entry = Entry.objects.get(feed=feed, item__guid='item-0')
+    assert entry.item.title == 'Item 0 fixed'
+    assert entry.state == 0, "updated entry not marked unread"
+    assert Entry.objects.filter(feed=feed, state=1).count() == 2
+
+@pytest.mark.django_db(transaction=True)
+def test_update_skips_unchanged_entries(feed_server):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+    Entry.objects.filter(feed=feed).update(state=1)
+
+    stats = sanitizer.stats()
+
+    # same date, only the content of item 1 changed
+    body = make_rss().replace(b'Body of item 1', b'New body of item 1')
+    FeedRequestHandler.documents['/rss'] = {'body': body}
+    feed._updateFeed(feed.id)
+
+    cleaned = sanitizer.stats()
+    assert cleaned['hits'] + cleaned['misses'] - stats['hits'] - stats['misses'] == 1, "unchanged entries were sanitised"
+    assert Entry.objects.get(feed=feed, item__guid='item-1').item.content == '<p>New body of item 1</p>'
+    assert Entry.objects.filter(feed=feed, state=1).count() == 2
+
+@pytest.mark.django_db(transaction=True)
+def test_update_items_without_hash(feed_server):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+    Entry.objects.mark(Entry.objects.filter(feed=feed), ENTRY_READ)
+
+    # stored before the items had a hash
+    Item.objects.update(content_hash=None)
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(title='Renamed')}
+    feed._updateFeed(feed.id)
+
+    assert not Item.objects.filter(content_hash=None).exists()
+    assert Entry.objects.filter(feed=feed, state=ENTRY_READ).count() == 3
+    assert Feed.objects.get(pk=feed.id).unread_count == 0
+
+def test_sanitizer_cache():
+    cache = Sanitizer(['p'], {}, [], cache_size=2)
+
+    assert cache.clean('<p onclick="x()">a</p><script>b</script>') == '<p>a</p>b'
+    assert cache.clean('<p onclick="x()">a</p><script>b</script>') == '<p>a</p>b'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+    cache.clean('<p>c</p>')
+    cache.clean('<p>d</p>')
+    stats = cache.stats()
+    assert stats['cached'] == 2, "cache not bounded"
+    assert stats['misses'] == 3
+    assert stats['time_spent'] > 0
+
+@pytest.mark.django_db(transaction=True)
+def test_source_schedule():
+    source = FeedSource.objects.create(link='http://127.0.0.1/rss')
+    now = timezone.now()
+
+    # nothing observed yet
+    source.schedule(created=10)
+    assert source.fetched_at is not None
+    assert source.next_fetch_at - now > datetime.timedelta(minutes=50)
+
+    # 6 new entries in 2 hours: about one new entry every 20 minutes
+    source.fetched_at = now - datetime.timedelta(hours=2)
+    source.schedule(created=6)
+    assert source.entry_rate == pytest.approx(3, rel=0.01)
+    assert datetime.timedelta(minutes=17) < source.next_fetch_at - source.fetched_at < datetime.timedelta(minutes=23)
+
+    # the feed's ttl is respected
+    source.ttl = 120
+    source.schedule()
+    assert source.next_fetch_at - source.fetched_at > datetime.timedelta(minutes=100)
+
+    # failures back off
+    source.ttl = None
+    source.entry_rate = 3
+    source.schedule(failed=True)
+    source.schedule(failed=True)
+    assert source.failures == 2
+    assert source.next_fetch_at - timezone.now() > datetime.timedelta(minutes=70)
+
+@pytest.mark.django_db(transaction=True)
+def test_dispatch_due_sources(monkeypatch):
+    from rss_feeder_api import tasks
+    monkeypatch.setattr(settings, 'SCHEDULER_BATCH_SIZE', 2)
+    sent = []
+    monkeypatch.setattr(FeedSource._updateSources, 'send_with_options', lambda **options: sent.append(options))
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    for i in range(5):
+        Feed.objects.create(link=f'http://127.0.0.1/rss/{i}', owner=user, nickname=f'{i}')
+    Feed.objects.filter(link='http://127.0.0.1/rss/4').update(flagged=True)
+    FeedSource.objects.filter(link='http://127.0.0.1/rss/3').update(next_fetch_at=timezone.now() + datetime.timedelta(hours=1))
+
+    assert tasks.dispatchDueSources() == 3
+    # 2 batches, the second one delayed to the middle of the tick
+    assert [len(options['args'][0]) for options in sent] == [2, 1]
+    assert [options['delay'] for options in sent] == [None, settings.SCHEDULER_TICK * 500]
+
+    assert tasks.dispatchDueSources() == 0, "sources dispatched again before being updated"
+
+@pytest.mark.django_db(transaction=True)
+def test_update_all_feeds_in_batches(monkeypatch):
+    from rss_feeder_api import tasks
+    monkeypatch.setattr(settings, 'FEED_UPDATE_BATCH_SIZE', 2)
+    sent = []
+    monkeypatch.setattr(FeedSource._updateSources, 'send', lambda pks: sent.append(pks))
+
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    user2 = User.objects.create_user('john2', 'lennon2@thebeatles.com', 'johnpassword')
+    for i in range(5):
+        Feed.objects.create(link=f'http://127.0.0.1/rss/{i}', owner=user, nickname=f'{i}')
+    Feed.objects.create(link='http://127.0.0.1/rss/0', owner=user2, nickname='0')
+    Feed.objects.filter(link='http://127.0.0.1/rss/4').update(flagged=True)
+
+    messages, sources, elapsed = tasks.updateAllFeeds()
+
+    assert (messages, sources) == (2, 4)
+    assert sorted(sum(sent, [])) == sorted(FeedSource.objects.exclude(link='http://127.0.0.1/rss/4').values_list('id', flat=True))
+
+def test_fetch_host_limits(feed_server):
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+    engine = fetcher.FetchEngine(host_limits={
+        'default': {'rate': 100, 'burst': 100, 'concurrency': 10},
+        '127.0.0.1': {'rate': 10, 'burst': 1, 'concurrency': 1},
+    })
+
+    try:
+        start = time.monotonic()
+        results = engine.fetch_many([(feed_server+'/rss', None, None)] * 4)
+        elapsed = time.monotonic() - start
+    finally:
+        engine.close()
+
+    # queued behind the host's limits, none of them failed
+    assert [result.status for result in results] == [200] * 4
+    assert elapsed >= 0.3
+
+@pytest.mark.django_db(transaction=True)
+def test_update_large_feed_streaming(feed_server, monkeypatch):
+    monkeypatch.setattr(settings, 'FEED_STREAM_THRESHOLD', 100)
+    monkeypatch.setattr(settings, 'ENTRY_STREAM_BATCH_SIZE', 2)
+    monkeypatch.setattr(settings, 'FEED_MAX_ENTRIES', 5)
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(n=7)}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+
+    assert Feed.objects.get(pk=feed.id).title == 'Local test feed'
+    assert Entry.objects.filter(feed=feed).count() == 5, "entry cap not applied"
+    entry = Entry.objects.get(feed=feed, item__guid='item-2')
+    assert entry.item.content == '<p>Body of item 2</p>'
+    assert entry.item.url == 'http://localhost/item/2'
+    assert entry.date.day == 3
+
+def test_streaming_parser_atom():
+    from io import BytesIO
+    from rss_feeder_api.streaming import StreamingParser
+    document = b"""<?xml version="1.0" encoding="utf-8"?>
+    <feed xmlns="http://www.w3.org/2005/Atom">
+      <title>Atom feed</title><link rel="self" href="http://localhost/atom"/><link href="http://localhost/"/>
+      <updated>2020-06-01T10:00:00Z</updated>
+      <entry><title>First</title><id>urn:1</id><link href="http://localhost/1"/>
+        <updated>2020-06-02T10:00:00+02:00</updated><author><name>Ringo</name></author>
+        <content type="xhtml"><div xmlns="http://www.w3.org/1999/xhtml"><p>Hi</p></div></content></entry>
+      <entry><title>Second</title><id>urn:2</id><summary>Short</summary></entry>
+    </feed>"""
+
+    parser = StreamingParser(BytesIO(document))
+    assert parser.feed['title'] == 'Atom feed'
+    assert parser.feed['link'] == 'http://localhost/'
+
+    entries = list(parser.entries())
+    assert [entry['guid'] for entry in entries] == ['urn:1', 'urn:2']
+    assert entries[0]['link'] == 'http://localhost/1'
+    assert entries[0]['author'] == 'Ringo'
+    assert entries[0]['updated_parsed'].tm_hour == 8
+    assert entries[0]['content'][0]['value'].strip() == '<div><p>Hi</p></div>'
+    assert entries[1]['description'] == 'Short'
+
+def test_fetch_max_bytes(feed_server, monkeypatch):
+    monkeypatch.setattr(settings, 'FEED_MAX_BYTES', 100)
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+
+    with pytest.raises(fetcher.FetchError):
+        fetcher.fetch(feed_server+'/rss')
+
+@pytest.mark.django_db(transaction=True)
+def test_entry_list_cursor_pagination(auto_login_user):
+    client, user = auto_login_user()
+    feed = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="test")
+    for i in range(25):
+        make_entry(feed, f'{i}', title=f'{i}')
+    # a few entries share the same update time
+    for i, entry in enumerate(Entry.objects.order_by('id')):
+        Entry.objects.filter(pk=entry.pk).update(updated_at=timezone.now() - datetime.timedelta(minutes=i // 3))
+
+    url = reverse('all-entries-list')
+    response = client.get(url+'?page_size=10&read=false')
+    assert 'count' not in response.data
+
+    seen = []
+    while True:
+        seen += [entry['id'] for entry in response.data['results']]
+        if not response.data['next']:
+            break
+        response = client.get(response.data['next'])
+
+    assert len(seen) == len(set(seen)) == 25
+    assert seen == list(Entry.objects.order_by('-updated_at', '-id').values_list('id', flat=True))
+
+    response = client.get(url+'?count=true&read=true')
+    assert response.data['count'] == 0
+
+def query_plan(queryset):
+    '''
+    the query plan of a queryset. Sequential scans are turned off on postgres,
+    where the planner would rather read the few rows of the test tables directly
+    '''
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+    return queryset.explain()
+
+@pytest.mark.django_db
+def test_entry_list_indexes(create_user):
+    user = create_user()
+    feed = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="test")
+
+    entries = Entry.objects.filter(feed__owner=user, feed__id=feed.id).order_by('-updated_at', '-id')
+    plan = query_plan(entries)
+    assert 'entry_feed_updated_idx' in plan
+
+    plan = query_plan(entries.filter(state=ENTRY_UNREAD))
+    assert 'entry_unread_feed_idx' in plan
+
+    if connection.vendor == 'sqlite':
+        # the index gives the rows in order
+        assert 'TEMP B-TREE' not in plan
+
+@pytest.mark.django_db
+def test_feed_indexes(create_user):
+    user = create_user()
+
+    plan = query_plan(Feed.objects.filter(owner=user).order_by('-updated_at'))
+    assert 'feed_owner_updated_idx' in plan
+
+    plan = query_plan(FeedSource.objects.followed())
+    assert 'feed_unflagged_source_idx' in plan
+
+@pytest.mark.django_db
+def test_notification_list_indexes(create_user):
+    user = create_user()
+
+    notifications = Notification.objects.filter(owner=user).order_by('-updated_at', '-id')
+    plan = query_plan(notifications)
+    assert 'notification_owner_updated_idx' in plan
+
+    plan = query_plan(notifications.filter(state=ENTRY_UNREAD))
+    assert 'notification_unread_owner_idx' in plan
+
+    if connection.vendor == 'sqlite':
+        assert 'TEMP B-TREE' not in plan
+
+@pytest.mark.django_db(transaction=True)
+def test_unread_counters(feed_server, auto_login_user):
+    client, user = auto_login_user()
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+    FeedRequestHandler.documents['/other'] = {'body': make_rss(2)}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    other = Feed.objects.create(link=feed_server+'/other', owner=user, nickname="other")
+    feed._updateFeed(feed.id)
+    other._updateFeed(other.id)
+
+    url = reverse('all-feeds-counts')
+    response = client.get(url)
+    assert response.data['unread'] == response.data['total'] == 5
+    assert response.data['feeds'] == [
+        {'id': feed.id, 'unread': 3, 'total': 3},
+        {'id': other.id, 'unread': 2, 'total': 2},
+    ]
+
+    # read one entry, then the feed republishes it changed: unread again
+    entry = Entry.objects.get(feed=feed, item__guid='item-0')
+    client.patch(reverse('entry-detail-detail', kwargs={'pk': entry.id})+'?read=true')
+    client.patch(reverse('entry-detail-detail', kwargs={'pk': entry.id})+'?read=true')
+    feed.refresh_from_db()
+    assert (feed.unread_count, feed.entry_count) == (2, 3)
+
+    body = make_rss(4).replace(b'<title>Item 0</title>', b'<title>Item 0 fixed</title>')
+    FeedRequestHandler.documents['/rss'] = {'body': body}
+    feed._updateFeed(feed.id)
+
+    feed.refresh_from_db()
+    assert (feed.unread_count, feed.entry_count) == (4, 4)
+    assert feed.unread_count == Entry.objects.filter(feed=feed, state=ENTRY_UNREAD).count()
+
+    other.delete()
+    response = client.get(url)
+    assert (response.data['unread'], response.data['total']) == (4, 4)
+
+@pytest.mark.django_db(transaction=True)
+def test_bulk_mark_read(auto_login_user, django_assert_max_num_queries):
+    client, user = auto_login_user()
+    feed = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="test")
+    other = Feed.objects.create(link="http://127.0.0.1/other", owner=user, nickname="other")
+    entries = [make_entry(feed, f'{i}', title=f'{i}') for i in range(6)]
+    make_entry(other, '0', title='0')
+    Entry.objects.filter(pk=entries[0].pk).update(updated_at=timezone.now() - datetime.timedelta(days=1))
+
+    url = reverse('all-entries-mark')
+    response = client.post(url, {'ids': [entries[1].id, entries[2].id]}, format='json')
+    assert response.data == {'count': 2}
+
+    before = (timezone.now() - datetime.timedelta(hours=1)).isoformat()
+    response = client.post(url, {'before': before}, format='json')
+    assert response.data == {'count': 1}
+
+    # one update per feed, whatever the number of entries
+    with django_assert_max_num_queries(12):
+        response = client.post(url, {'feed_id': feed.id}, format='json')
+    assert response.data == {'count': 3}
+    assert Entry.objects.filter(feed=feed, state=ENTRY_UNREAD).count() == 0
+    assert Entry.objects.get(feed=other).state == ENTRY_UNREAD
+
+    response = client.post(url, {'ids': [entries[0].id], 'read': False}, format='json')
+    assert response.data == {'count': 1}
+
+    feed.refresh_from_db()
+    assert feed.unread_count == 1
+    assert user.counter.unread_count == 2
+
+    # all of them, the counters moved by the entries that changed only
+    for count in (2, 0):
+        response = client.post(url, {}, format='json')
+        assert response.data == {'count': count}
+    user.counter.refresh_from_db()
+    assert user.counter.unread_count == 0
+    assert list(Feed.objects.filter(owner=user).values_list('unread_count', flat=True)) == [0, 0]
+
+    response = client.post(url, {'before': 'yesterday'}, format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+@pytest.mark.django_db(transaction=True)
+def test_bulk_mark_notifications_read(auto_login_user):
+    client, user = auto_login_user()
+    feed = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="test")
+    Notification.objects.bulk_create([Notification(owner=user, feed=feed, title=f'{i}') for i in range(3)])
+
+    response = client.post(reverse('all-notifications-mark'), {}, format='json')
+    assert response.data == {'count': 3}
+    assert Notification.objects.filter(owner=user, state=ENTRY_UNREAD).count() == 0
+
+@pytest.mark.django_db(transaction=True)
+def test_entry_list_summary_and_fields(auto_login_user):
+    client, user = auto_login_user()
+    feed = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="test")
+    for i in range(3):
+        make_entry(feed, f'{i}', title=f'{i}', content=f'<p>Body &amp; <b>text</b> of {i}</p>' + ' word' * 100)
+
+    url = reverse('all-entries-list')
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url+'?summary=true')
+    entry = response.data['results'][0]
+    assert 'content' not in entry
+    assert entry['excerpt'].startswith('Body & text of 2 word')
+    assert len(entry['excerpt']) == settings.ENTRY_EXCERPT_LENGTH
+    # the content is not read from the database either
+    assert not any('"rss_feeder_api_item"."content",' in query['sql'] for query in queries.captured_queries)
+
+    response = client.get(url+'?fields=id,title,state')
+    assert set(response.data['results'][0]) == {'id', 'title', 'state'}
+
+    response = client.get(url+'?fields=id,nope')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    # the full content is still sent by the detail view
+    response = client.get(reverse('entry-detail-detail', kwargs={'pk': entry['id']}))
+    assert response.data['content'].startswith('<p>Body')
+
+@pytest.mark.django_db(transaction=True)
+def test_list_etags(feed_server, auto_login_user, django_assert_max_num_queries):
+    client, user = auto_login_user()
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+
+    urls = [reverse('all-entries-list')+'?summary=true', reverse('all-feeds-list'), reverse('all-notifications-list'), reverse('all-feeds-counts')]
+    etags = {}
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        etags[url] = response['ETag']
+
+        # unchanged: a 304, without reading the lists
+        with django_assert_max_num_queries(4) as queries:
+            response = client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert not any('rss_feeder_api_entry' in query['sql'] for query in queries.captured_queries)
+
+    assert len(set(etags.values())) == len(urls), "the etag does not depend on the page"
+
+    # every change for the user makes every list changed
+    def changed():
+        return all(client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code == status.HTTP_200_OK for url in urls)
+
+    entry = Entry.objects.filter(feed=feed).first()
+    client.patch(reverse('entry-detail-detail', kwargs={'pk': entry.id})+'?read=true')
+    assert changed()
+    etags = dict((url, client.get(url)['ETag']) for url in urls)
+
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(4)}
+    feed._updateFeed(feed.id)
+    assert changed()
+    etags = dict((url, client.get(url)['ETag']) for url in urls)
+
+    client.post(reverse('all-notifications-mark'), {}, format='json')
+    Notification.objects.create(owner=user, feed=feed, title='test')
+    assert changed()
+
+    # nothing changed for the user: still a 304
+    etags = dict((url, client.get(url)['ETag']) for url in urls)
+    other = User.objects.create_user('paul', 'paul@thebeatles.com', 'paulpassword')
+    Feed.objects.create(link=feed_server+'/rss', owner=other, nickname="test")
+    assert client.get(urls[0], HTTP_IF_NONE_MATCH=etags[urls[0]]).status_code == status.HTTP_304_NOT_MODIFIED
+
+@pytest.mark.django_db(transaction=True)
+def test_entry_search(feed_server, auto_login_user, monkeypatch):
+    client, user = auto_login_user()
+    body = make_rss(12).replace(b'<title>Item 3</title>', b'<title>Item 3 about zebras</title>')
+    body = body.replace(b'Body of item 7', b'Body of item 7, zebras zebras <b>zebra</b>')
+    FeedRequestHandler.documents['/rss'] = {'body': body}
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    # the same feed for another user is not searched
+    other = User.objects.create_user('paul', 'paul@thebeatles.com', 'paulpassword')
+    Feed.objects.create(link=feed_server+'/rss', owner=other, nickname="test")
+    feed._updateFeed(feed.id)
+    assert Entry.objects.filter(feed__owner=other).count() == 12
+
+    url = reverse('all-entries-search')
+    response = client.get(url+'?q=zebra&summary=true')
+    assert response.status_code == status.HTTP_200_OK
+    assert [entry['title'] for entry in response.data['results']] == ['Item 7', 'Item 3 about zebras']
+
+    # all the words must match
+    response = client.get(url+'?q=zebras+item+3')
+    assert [entry['title'] for entry in response.data['results']] == ['Item 3 about zebras']
+
+    # the index follows the updates of the entries, and fts syntax is not interpreted
+    body = body.replace(b'Item 3 about zebras', b'Item 3 about lions')
+    FeedRequestHandler.documents['/rss'] = {'body': body}
+    feed._updateFeed(feed.id)
+    response = client.get(url+'?q=zebras "OR lions')
+    assert response.data['results'] == []
+
+    # ranked cursor pagination
+    response = client.get(url+'?q=item&page_size=5')
+    seen = []
+    while True:
+        seen += [entry['id'] for entry in response.data['results']]
+        if not response.data['next']:
+            break
+        response = client.get(response.data['next'])
+    assert sorted(seen) == sorted(Entry.objects.filter(feed=feed).values_list('id', flat=True))
+
+    response = client.get(url+'?q=')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    # not an error of the server on the databases without full-text search
+    monkeypatch.setattr(connection, 'vendor', 'mysql')
+    response = client.get(url+'?q=zebra')
+    assert response.status_code == status.HTTP_501_NOT_IMPLEMENTED
+
+@pytest.mark.django_db(transaction=True)
+def test_add_counts(create_user, django_assert_num_queries):
+    user = create_user()
+    other = User.objects.create_user('paul', 'paul@thebeatles.com', 'paulpassword')
+    feeds = [Feed.objects.create(link=f"http://127.0.0.1/rss/{i}", owner=user if i else other, nickname="test") for i in range(4)]
+
+    # one update of all the feeds, one of all their owners
+    with django_assert_num_queries(2):
+        Feed.objects.add_counts(
+            dict((feed.id, (i, 2 * i)) for i, feed in enumerate(feeds, 1)),
+            owners=dict((feed.id, feed.owner_id) for feed in feeds),
+        )
+
+    assert [Feed.objects.values_list('unread_count', 'entry_count').get(pk=feed.id) for feed in feeds] == [(1, 2), (2, 4), (3, 6), (4, 8)]
+    assert UserCounter.objects.values_list('unread_count', 'entry_count').get(user=user) == (9, 18)
+    assert UserCounter.objects.values_list('unread_count', 'entry_count').get(user=other) == (1, 2)
+
+@pytest.mark.django_db(transaction=True)
+def test_notification_coalescing(create_user, django_assert_max_num_queries):
+    from rss_feeder_api.models import notify_update_success, notify_update_failure
+    from rss_feeder_api import tasks
+
+    user = create_user()
+    feeds = [Feed.objects.create(link=f"http://127.0.0.1/rss/{i}", owner=user, nickname="test") for i in range(3)]
+
+    # one insert for all the feeds
+    with django_assert_max_num_queries(6):
+        notify_update_success(Feed.objects.filter(owner=user))
+    notify_update_success(Feed.objects.filter(owner=user))
+    notify_update_failure(Feed.objects.filter(pk=feeds[0].pk), 'FeedError', 'failed')
+
+    assert Notification.objects.count() == 4
+    assert set(Notification.objects.filter(title='FeedUpdated').values_list('count', flat=True)) == {2}
+
+    # once read, the next notification starts a new one
+    Notification.objects.filter(feed=feeds[0], title='FeedUpdated').update(state=ENTRY_READ)
+    notify_update_success(Feed.objects.filter(pk=feeds[0].pk))
+    assert Notification.objects.filter(feed=feeds[0], title='FeedUpdated').count() == 2
+
+    # only the read notifications past the retention are pruned
+    Notification.objects.update(updated_at=timezone.now() - datetime.timedelta(days=settings.NOTIFICATION_RETENTION_DAYS + 1))
+    Notification.objects.filter(feed=feeds[1]).update(state=ENTRY_READ)
+    assert tasks.pruneNotifications() == 2
+    assert Notification.objects.filter(state=ENTRY_READ).count() == 0
+    assert Notification.objects.count() == 3
+
+@pytest.mark.django_db(transaction=True)
+def test_entry_retention(create_user, monkeypatch):
+    from rss_feeder_api import tasks
+
+    user = create_user()
+    feed = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="test")
+    now = timezone.now()
+    for i in range(8):
+        make_entry(feed, f'{i}', title=f'{i}', date=now - datetime.timedelta(days=i * 10), state=ENTRY_READ if i % 2 else ENTRY_UNREAD)
+
+    monkeypatch.setattr(settings, 'ENTRY_RETENTION_DAYS', 25)
+    monkeypatch.setattr(settings, 'ENTRY_RETENTION_MAX_ENTRIES', None)
+    monkeypatch.setattr(settings, 'ENTRY_DELETE_BATCH_SIZE', 1)
+
+    # only the read entries older than 25 days: 3, 5, 7
+    assert tasks.pruneEntries() == 3
+    assert sorted(Entry.objects.filter(feed=feed).values_list('item__guid', flat=True)) == ['0', '1', '2', '4', '6']
+
+    # the limits of the feed, without keeping the unread entries
+    monkeypatch.setattr(settings, 'ENTRY_RETENTION_KEEP_UNREAD', False)
+    feed.retention_days = 0
+    feed.retention_max_entries = 2
+    feed.save()
+    assert tasks.pruneEntries() == 3
+    assert sorted(Entry.objects.filter(feed=feed).values_list('item__guid', flat=True)) == ['0', '1']
+
+    feed.refresh_from_db()
+    user.counter.refresh_from_db()
+    assert (feed.unread_count, feed.entry_count) == (1, 2)
+    assert (user.counter.unread_count, user.counter.entry_count) == (1, 2)
+
+@pytest.mark.django_db(transaction=True)
+def test_entry_retention_on_update(feed_server, create_user, monkeypatch):
+    user = create_user()
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+    FeedRequestHandler.documents['/other'] = {'body': make_rss(n=2)}
+
+    # the test documents are dated 2020, past the retention, but unread
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+    assert Entry.objects.filter(feed=feed).count() == 3
+
+    # not written if the job would delete them right away
+    monkeypatch.setattr(settings, 'ENTRY_RETENTION_KEEP_UNREAD', False)
+    other = Feed.objects.create(link=feed_server+'/other', owner=user, nickname="other")
+    other._updateFeed(other.id)
+    assert Entry.objects.filter(feed=other).count() == 0
+
+@pytest.mark.django_db(transaction=True)
+def test_entry_retention_then_update(feed_server, create_user):
+    from email.utils import format_datetime
+    from rss_feeder_api import tasks
+
+    user = create_user()
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    feed._updateFeed(feed.id)
+
+    # the read entries past the retention, and their items, are deleted
+    Entry.objects.mark(Entry.objects.filter(feed=feed, item__guid__in=['item-0', 'item-1']), ENTRY_READ)
+    assert tasks.pruneEntries() == 2
+    assert Item.objects.count() == 1
+
+    # the next update does not write them again as unread, but new ones
+    recent = (
+        f'<item><title>Recent</title><guid>recent</guid>'
+        f'<pubDate>{format_datetime(timezone.now() - datetime.timedelta(hours=1))}</pubDate></item></channel>'
+    ).encode('utf-8')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss().replace(b'</channel>', recent)}
+    feed._updateFeed(feed.id)
+
+    assert sorted(Entry.objects.filter(feed=feed).values_list('item__guid', flat=True)) == ['item-2', 'recent']
+    feed.refresh_from_db()
+    assert (feed.unread_count, feed.entry_count) == (2, 2)
+
+@pytest.mark.django_db(transaction=True)
+def test_delete_feed_later(auto_login_user, broker):
+    client, user = auto_login_user()
+    feed = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="test")
+    for i in range(5):
+        make_entry(feed, f'{i}', title=f'{i}')
+    Notification.objects.create(owner=user, feed=feed, title='test')
+
+    response = client.delete(reverse('feeds-detail-detail', kwargs={'pk': feed.id}))
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+
+    # hidden at once, the entries are still there until the actor runs
+    assert client.get(reverse('feeds-detail-detail', kwargs={'pk': feed.id})).status_code == status.HTTP_404_NOT_FOUND
+    assert client.get(reverse('all-entries-list')).data['results'] == []
+    assert Entry.objects.filter(feed=feed).count() == 5
+    assert Notification.objects.filter(feed=feed).count() == 0
+    user.counter.refresh_from_db()
+    assert (user.counter.unread_count, user.counter.entry_count) == (0, 0)
+
+    # the same link can be added again right away
+    again = Feed.objects.create(link="http://127.0.0.1/rss", owner=user, nickname="again")
+
+    Feed._deleteFeed(feed.id)
+    assert not Feed.objects.filter(pk=feed.id).exists()
+    assert Entry.objects.filter(feed_id=feed.id).count() == 0
+    assert Feed.objects.filter(owner=user).get() == again
+    # given the items the source already had
+    assert Entry.objects.filter(feed=again).count() == 5
+
+@pytest.mark.django_db(transaction=True)
+def test_shared_items(feed_server, auto_login_user):
+    from rss_feeder_api import tasks
+
+    client, user = auto_login_user()
+    other = User.objects.create_user('paul', 'paul@thebeatles.com', 'paulpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    Feed.objects.create(link=feed_server+'/rss', owner=other, nickname="test")
+    feed._updateFeed(feed.id)
+
+    # the content is stored once, each user has their entries
+    assert Item.objects.count() == 3
+    assert Entry.objects.count() == 6
+
+    # the same fields as before the content was shared
+    entry = Entry.objects.get(feed=feed, item__guid='item-0')
+    response = client.get(reverse('entry-detail-detail', kwargs={'pk': entry.id}))
+    assert list(response.data) == [
+        'id', 'feed', 'state', 'title', 'content', 'excerpt', 'date', 'author', 'url', 
+        'comments_url', 'guid', 'content_hash', 'last_updated', 'created_at', 'updated_at',
+    ]
+    assert response.data['title'] == 'Item 0'
+    assert response.data['content'] == '<p>Body of item 0</p>'
+
+    # the read state is per user, a change of the item is seen by both
+    client.patch(reverse('entry-detail-detail', kwargs={'pk': entry.id})+'?read=true')
+    assert Entry.objects.filter(item=entry.item, state=ENTRY_READ).count() == 1
+
+    body = make_rss().replace(b'<title>Item 0</title>', b'<title>Item 0 fixed</title>')
+    FeedRequestHandler.documents['/rss'] = {'body': body}
+    feed._updateFeed(feed.id)
+    assert Item.objects.count() == 3
+    assert list(Entry.objects.filter(item=entry.item).values_list('item__title', 'state')) == [('Item 0 fixed', ENTRY_UNREAD)] * 2
+
+    # the items are deleted with the last of their entries
+    Entry.objects.filter(feed__owner=other).delete()
+    assert tasks.pruneEntries() == 0
+    assert Item.objects.count() == 3
+    Entry.objects.filter(feed=feed, item__guid='item-1').delete()
+    tasks.pruneEntries()
+    assert sorted(Item.objects.values_list('guid', flat=True)) == ['item-0', 'item-2']
+
+@pytest.mark.django_db(transaction=True)
+def test_update_metrics(feed_server):
+    from prometheus_client import REGISTRY
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(), 'etag': '"v1"'}
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+
+    names = [
+        ('rss_feeder_fetch_seconds_count', {'host': '127.0.0.1', 'outcome': 'ok'}),
+        ('rss_feeder_fetch_bytes_sum', {'host': '127.0.0.1'}),
+        ('rss_feeder_fetch_responses_total', {'host': '127.0.0.1', 'status': '200'}),
+        ('rss_feeder_fetch_responses_total', {'host': '127.0.0.1', 'status': '304'}),
+        ('rss_feeder_parse_seconds_count', {'parser': 'feedparser'}),
+        ('rss_feeder_entry_parse_seconds_count', {}),
+        ('rss_feeder_sanitize_seconds_count', {}),
+        ('rss_feeder_db_seconds_count', {'operation': 'write'}),
+        ('rss_feeder_entries_total', {'result': 'created'}),
+        ('rss_feeder_entries_total', {'result': 'updated'}),
+        ('rss_feeder_entries_total', {'result': 'skipped'}),
+        ('rss_feeder_updates_total', {'outcome': 'updated'}),
+        ('rss_feeder_updates_total', {'outcome': 'not_modified'}),
+    ]
+    before = [sample(name, **labels) for name, labels in names]
+
+    feed._updateFeed(feed.id)
+    # one changed entry, the others skipped
+    body = make_rss().replace(b'<title>Item 0</title>', b'<title>Item 0 fixed</title>')
+    FeedRequestHandler.documents['/rss'] = {'body': body, 'etag': '"v2"'}
+    feed._updateFeed(feed.id)
+    # not modified
+    feed._updateFeed(feed.id)
+
+    increase = dict(((name, tuple(labels.values())), sample(name, **labels) - value) for (name, labels), value in zip(names, before))
+    assert increase[('rss_feeder_fetch_seconds_count', ('127.0.0.1', 'ok'))] == 3
+    assert increase[('rss_feeder_fetch_bytes_sum', ('127.0.0.1',))] == len(make_rss()) + len(body)
+    assert increase[('rss_feeder_fetch_responses_total', ('127.0.0.1', '200'))] == 2
+    assert increase[('rss_feeder_fetch_responses_total', ('127.0.0.1', '304'))] == 1
+    assert increase[('rss_feeder_parse_seconds_count', ('feedparser',))] == 2
+    assert increase[('rss_feeder_entry_parse_seconds_count', ())] == 2
+    assert increase[('rss_feeder_sanitize_seconds_count', ())] == 2
+    assert increase[('rss_feeder_db_seconds_count', ('write',))] == 2
+    assert increase[('rss_feeder_entries_total', ('created',))] == 3
+    assert increase[('rss_feeder_entries_total', ('updated',))] == 1
+    assert increase[('rss_feeder_entries_total', ('skipped',))] == 2
+    assert increase[('rss_feeder_updates_total', ('updated',))] == 2
+    assert increase[('rss_feeder_updates_total', ('not_modified',))] == 1
+
+@pytest.mark.django_db(transaction=True)
+def test_update_outcome_without_callbacks(feed_server, broker, monkeypatch):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    other = User.objects.create_user('paul', 'mccartney@thebeatles.com', 'paulpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss()}
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test", flagged=True)
+    Feed.objects.create(link=feed_server+'/rss', owner=other, nickname="test", flagged=True)
+
+    # a single message, without callbacks
+    feed.force_update()
+    assert broker.queues['default'].qsize() == 1
+    message = json.loads(broker.queues['default'].get_nowait())
+    broker.queues['default'].task_done()
+    assert message['args'] == [feed.id]
+    assert 'on_success' not in message['options'] and 'on_failure' not in message['options']
+
+    Feed._updateFeed(feed.id)
+    assert Feed.objects.filter(flagged=False).count() == 2
+    assert Notification.objects.filter(title='FeedUpdated').count() == 2
+
+    # the failure is recorded for every subscriber, after the rollback
+    monkeypatch.setattr(settings, 'MAX_FEED_UPDATE_RETRIES', 1)
+    FeedRequestHandler.documents = {}
+    with pytest.raises(FeedError):
+        Feed._updateFeed(feed.id)
+    assert Feed.objects.filter(flagged=True).count() == 2
+    assert Notification.objects.filter(title='FeedError').count() == 2
+
+@pytest.mark.django_db(transaction=True)
+def test_update_trace(feed_server, broker, worker, monkeypatch, caplog):
+    from rss_feeder_api import tracing
+
+    monkeypatch.setattr(settings, 'TRACE_SAMPLE_RATE', 1)
+    logger = logging.getLogger('rss_feeder.trace')
+    logger.addHandler(caplog.handler)
+    caplog.set_level(logging.INFO, logger='rss_feeder.trace')
+
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(), 'etag': '"v1"'}
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+
+    try:
+        feed.force_update()
+        broker.join("default")
+        worker.join()
+    finally:
+        logger.removeHandler(caplog.handler)
+
+    records = [record for record in caplog.records if record.name == 'rss_feeder.trace']
+    line = json.loads(tracing.JSONFormatter().format(records[0]))
+    records = [record.fields for record in records]
+    events = [record['event'] for record in records]
+    for name in ('force_update', '_updateFeed', 'fetch', 'parse', 'store', 'update_succeeded'):
+        assert name in events, f'{name} not traced in {events}'
+
+    # a single trace from the call to the outcome
+    assert len(set(record['trace_id'] for record in records)) == 1
+
+    spans = dict((record['event'], record) for record in records)
+    assert spans['_updateFeed']['parent_id'] == spans['force_update']['span_id']
+    assert spans['fetch']['parent_id'] == spans['_updateFeed']['span_id']
+    assert spans['fetch']['status'] == 200
+    assert spans['store']['created'] == 3
+    assert spans['store']['outcome'] == 'ok'
+
+    # the records are written as json
+    assert line['trace_id'] == records[0]['trace_id']
+    assert line['event'] == records[0]['event']
+
+    # not sampled, only the failures are logged
+    monkeypatch.setattr(settings, 'TRACE_SAMPLE_RATE', 0)
+    caplog.clear()
+    logger.addHandler(caplog.handler)
+    try:
+        with tracing.trace():
+            tracing.event('skipped')
+            tracing.event('failed', level=logging.WARNING)
+    finally:
+        logger.removeHandler(caplog.handler)
+    assert [record.fields['event'] for record in caplog.records if record.name == 'rss_feeder.trace'] == ['failed']
+
+@pytest.mark.django_db(transaction=True)
+def test_update_fetch_outside_transaction(feed_server, monkeypatch):
+    import feedparser
+    from rss_feeder_api import fetcher
+
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/a'] = {'body': make_rss(n=2)}
+    FeedRequestHandler.documents['/b'] = {'body': make_rss(n=3)}
+    feed_a = Feed.objects.create(link=feed_server+'/a', owner=user, nickname="a")
+    feed_b = Feed.objects.create(link=feed_server+'/b', owner=user, nickname="b")
+
+    # whether a transaction was open, at each fetch and parse
+    in_transaction = []
+    def outside(function):
+        def wrapper(*args, **kwargs):
+            in_transaction.append((function.__name__, connection.in_atomic_block))
+            return function(*args, **kwargs)
+        return wrapper
+    monkeypatch.setattr(fetcher, 'fetch', outside(fetcher.fetch))
+    monkeypatch.setattr(fetcher, 'fetch_many', outside(fetcher.fetch_many))
+    monkeypatch.setattr(feedparser, 'parse', outside(feedparser.parse))
+
+    Feed._updateFeed(feed_a.id)
+    assert in_transaction == [('fetch', False), ('parse', False)]
+    assert Entry.objects.filter(feed=feed_a).count() == 2
+
+    in_transaction.clear()
+    FeedRequestHandler.documents['/a'] = {'body': make_rss(n=4)}
+    FeedSource._updateSources([feed_a.source_id, feed_b.source_id])
+    assert in_transaction == [('fetch_many', False), ('parse', False), ('parse', False)]
+    assert Entry.objects.filter(feed=feed_a).count() == 4
+    assert Entry.objects.filter(feed=feed_b).count() == 3
+
+@pytest.mark.django_db(transaction=True)
+def test_update_version_after_entries(feed_server, monkeypatch):
+    user = User.objects.create_user('john', 'lennon@thebeatles.com', 'johnpassword')
+    FeedRequestHandler.documents['/rss'] = {'body': make_rss(n=5)}
+    feed = Feed.objects.create(link=feed_server+'/rss', owner=user, nickname="test")
+    version = UserCounter.objects.get(user=user).version
+
+    # the version seen by a list read while each batch is written
+    versions = []
+    reconcile = Entry.objects.reconcile
+    def reconcile_and_read(*args, **kwargs):
+        versions.append(UserCounter.objects.get(user=user).version)
+        return reconcile(*args, **kwargs)
+    monkeypatch.setattr(Entry.objects, 'reconcile', reconcile_and_read)
+    monkeypatch.setattr(settings, 'ENTRY_STREAM_BATCH_SIZE', 2)
+
+    # not bumped with the feed details, ahead of the entries, but with
+    # each batch and once they are all written
+    Feed._updateFeed(feed.id)
+    assert len(versions) == 3
+    assert versions[0] == version
+    assert UserCounter.objects.get(user=user).version > versions[-1]
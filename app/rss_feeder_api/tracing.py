@@ -0,0 +1,179 @@
+'''
+Trace ids and timing spans of the feed updates, as structured log records.
+
+A trace is started by force_update() or by a scheduler task, and its id is
+carried in the options of the dramatiq messages by TraceMiddleware: from
+the _updateFeed or _updateSources message to its retries, up to the
+recorded outcome of the update. Each message run is a span, and so are the
+stages of an update (fetch, parse, store).
+
+Spans and events are logged as one JSON object per line on the
+"rss_feeder.trace" logger (see LOGGING in the settings). Traces are sampled
+as a whole, TRACE_SAMPLE_RATE of them are logged in full. Spans slower than
+TRACE_SLOW_SECONDS, failed spans and warnings are always logged.
+'''
+
+import contextvars
+import datetime
+import json
+import logging
+import random
+import time
+import uuid
+
+from contextlib import contextmanager
+
+from dramatiq.middleware import Middleware
+
+from rss_feeder import settings
+
+
+logger = logging.getLogger('rss_feeder.trace')
+
+# (trace id, sampled) of the trace running in this thread, and the id of its innermost span
+_trace = contextvars.ContextVar('trace', default=None)
+_span = contextvars.ContextVar('span', default=None)
+
+
+def new_trace():
+    return uuid.uuid4().hex, random.random() < settings.TRACE_SAMPLE_RATE
+
+
+def current():
+    '''
+    returns the (trace id, sampled) of the running trace, or None
+    '''
+    return _trace.get()
+
+
+@contextmanager
+def trace(trace=None):
+    '''
+    runs the block in a trace: the given (trace id, sampled), the running
+    one, or a new one
+    '''
+    token = _trace.set(trace or _trace.get() or new_trace())
+    try:
+        yield _trace.get()
+    finally:
+        _trace.reset(token)
+
+
+def _log(level, name, fields, sampled=None):
+    trace_id, trace_sampled = _trace.get() or (None, random.random() < settings.TRACE_SAMPLE_RATE)
+    if sampled is None:
+        sampled = trace_sampled
+    if not sampled and level < logging.WARNING:
+        return
+
+    record = {'event': name, 'trace_id': trace_id}
+    record.update(fields)
+    logger.log(level, name, extra={'fields': record})
+
+
+def event(name, level=logging.INFO, **fields):
+    '''
+    logs a structured record in the running trace, if it is sampled or
+    the level is a warning or above
+    '''
+    _log(level, name, fields)
+
+
+def log_span(name, duration, error=None, **fields):
+    '''
+    logs a span that was timed elsewhere, see span()
+    '''
+    slow = duration >= settings.TRACE_SLOW_SECONDS
+    fields['duration_ms'] = round(duration * 1000, 3)
+    fields['outcome'] = 'ok' if error is None else 'error'
+    if error is not None:
+        fields['error'] = '%s: %s' % (error.__class__.__name__, error)
+    if slow:
+        fields['slow'] = True
+
+    _log(logging.INFO if error is None else logging.WARNING, name, fields, sampled=slow or None)
+
+
+@contextmanager
+def span(name, **fields):
+    '''
+    times the block and logs it as a span of the running trace (a new one
+    if there is none), with its parent span and fields.
+
+    The fields can be completed in the block through the yielded dict:
+
+        with tracing.span('store', source_id=source.id) as fields:
+            fields['created'] = ...
+    '''
+    with trace():
+        span_id = uuid.uuid4().hex[:16]
+        fields.update(span_id=span_id, parent_id=_span.get())
+        token = _span.set(span_id)
+
+        start = time.perf_counter()
+        error = None
+        try:
+            yield fields
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _span.reset(token)
+            log_span(name, time.perf_counter() - start, error=error, **fields)
+
+
+class TraceMiddleware(Middleware):
+    '''
+    Carries the running trace in the options of the enqueued messages, and
+    runs each message in its trace (a new one if it has none), as a span
+    named after the actor, with the message id as span id.
+    '''
+    def __init__(self):
+        # message id: (start time, parent span id)
+        self.message_spans = {}
+
+    def before_enqueue(self, broker, message, delay):
+        running = _trace.get()
+        if running is not None and 'trace_id' not in message.options:
+            message.options['trace_id'], message.options['trace_sampled'] = running
+            message.options['trace_parent_id'] = _span.get()
+
+    def before_process_message(self, broker, message):
+        trace_id = message.options.get('trace_id', None)
+        _trace.set((trace_id, message.options.get('trace_sampled', False)) if trace_id else new_trace())
+        _span.set(message.message_id)
+
+        self.message_spans[message.message_id] = (time.perf_counter(), message.options.get('trace_parent_id', None))
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        start, parent_id = self.message_spans.pop(message.message_id, (None, None))
+        if start is not None:
+            log_span(
+                message.actor_name, time.perf_counter() - start, error=exception,
+                span_id=message.message_id, parent_id=parent_id,
+                retries=message.options.get('retries', 0),
+            )
+
+        _trace.set(None)
+        _span.set(None)
+
+    after_skip_message = after_process_message
+
+
+class JSONFormatter(logging.Formatter):
+    '''
+    formats a log record as a JSON object on a single line, with the fields
+    of the tracing records
+    '''
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
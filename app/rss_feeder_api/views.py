@@ -1,17 +1,23 @@
-from rss_feeder_api.models import Feed, Entry, Notification
-from rss_feeder_api.serializers import FeedSerializer, UserSerializer, EntrySerializer, NotificationSerializer
+import hashlib
+
+from rss_feeder_api.models import Feed, Entry, Notification, UserCounter
+from rss_feeder_api.serializers import FeedSerializer, UserSerializer, EntrySerializer, EntrySummarySerializer, NotificationSerializer, MarkStateSerializer
 from rest_framework import generics
 from django.contrib.auth.models import User
 
 from rest_framework import permissions, status
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 
 from rss_feeder_api.constants import ENTRY_UNREAD, ENTRY_READ
+from rss_feeder_api.pagination import UpdatedCursorPagination, RankCursorPagination
+from rss_feeder_api.search import search_entries, SearchUnavailable
 
 
 from django.shortcuts import get_object_or_404
 
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 
 from rest_framework import viewsets
 
@@ -21,6 +27,33 @@ from rest_framework.decorators import action
 ####################################################
 ####################################################
 
+def user_etag(request, *args, **kwargs):
+    '''
+    the ETag of a list response: it changes with the version of the user,
+    bumped by every change to their feeds, entries and notifications, and 
+    with the page asked for. Unchanged polls are answered with a 304 
+    without querying the lists
+    '''
+    version = UserCounter.objects.filter(user=request.user).values_list('version', flat=True).first()
+    key = '%s:%s:%s' % (request.user.id, version or 0, request.get_full_path())
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def filter_marked(queryset, data):
+    '''
+    narrows a queryset of entries or notifications down to the items to mark,
+    from validated MarkStateSerializer data
+    '''
+    if 'feed_id' in data:
+        queryset = queryset.filter(feed__id=data['feed_id'])
+    if 'ids' in data:
+        queryset = queryset.filter(id__in=data['ids'])
+    if 'before' in data:
+        queryset = queryset.filter(updated_at__lte=data['before'])
+    return queryset
+
+####################################################
+####################################################
+
 class UserList(mixins.ListModelMixin, viewsets.GenericViewSet):
     permission_classes = [permissions.IsAdminUser]
     queryset = User.objects.filter()
@@ -38,6 +71,7 @@ class UserDetail(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
 ####################################################
 ####################################################
 
+@method_decorator(condition(etag_func=user_etag), name='list')
 class EntryList(mixins.ListModelMixin,viewsets.GenericViewSet):
     """
     get:
@@ -54,13 +88,61 @@ class EntryList(mixins.ListModelMixin,viewsets.GenericViewSet):
               type: boolean
               description: filter based on read status
               required: false
+            - name: count
+              in: path
+              type: boolean
+              description: include the total number of matching entries (slower)
+              required: false
+            - name: cursor
+              in: path
+              type: string
+              description: the page to get, as given by the next/previous links
+              required: false
+            - name: summary
+              in: path
+              type: boolean
+              description: send the entries without their content, with a plain text excerpt instead
+              required: false
+            - name: fields
+              in: path
+              type: string
+              description: comma separated names of the only fields to send
+              required: false
     """
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = UpdatedCursorPagination
+
+    def get_serializer_class(self):
+        summary = self.request.GET.get('summary', None)
+        if summary == 'true' or summary == 'True':
+            return EntrySummarySerializer
+        return EntrySerializer
+
+    def get_fields(self):
+        '''
+        the names of the entry fields to send
+        '''
+        serializer_fields = list(self.get_serializer_class()().fields)
+
+        fields = self.request.GET.get('fields', None)
+        if not fields:
+            return serializer_fields
+
+        fields = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = set(fields) - set(serializer_fields)
+        if unknown:
+            raise ValidationError({'fields': 'unknown fields: %s' % ', '.join(sorted(unknown))})
+        return fields
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs['fields'] = self.get_fields()
+        return super(EntryList, self).get_serializer(*args, **kwargs)
+
     def get_queryset(self):
         feed_id = self.request.GET.get('feed_id', None)
         read = self.request.GET.get('read', None)
 
-        filter_kwargs ={"feed__owner": self.request.user}
+        filter_kwargs ={"feed__owner": self.request.user, "feed__deleted": False}
         if feed_id:
             print("filtering feed_id")
             filter_kwargs['feed__id'] = feed_id
@@ -71,12 +153,58 @@ class EntryList(mixins.ListModelMixin,viewsets.GenericViewSet):
             else:
                 filter_kwargs['state'] = ENTRY_UNREAD
 
-        return Entry.objects.filter(**filter_kwargs)
+        entries = Entry.objects.filter(**filter_kwargs).select_related('item')
+
+        # only read the columns that are sent, and the ones of the cursor
+        fields = set(self.get_fields()) | {'id', 'updated_at'}
+        return entries.only('item', *[
+            'item__' + name if name in Entry.CONTENT_FIELDS else name for name in fields
+        ])
         
 
     queryset = Entry.objects.all()
     serializer_class = EntrySerializer
 
+    @action(detail=False, methods=['get'])
+    @method_decorator(condition(etag_func=user_etag))
+    def search(self, request):
+        """
+        Full-text search of the entries of the user, best matches first. 
+        Takes the words to search for as q, and the filters, summary and 
+        fields parameters of the entry list
+        """
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response({'q': 'the words to search for are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            entries = search_entries(self.get_queryset(), query)
+        except SearchUnavailable as e:
+            return Response(str(e), status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        paginator = RankCursorPagination()
+        page = paginator.paginate_queryset(entries, request, view=self)
+        serializer = self.get_serializer(page, many=True)
+
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['post'])
+    def mark(self, request):
+        """
+        Mark many entries read (or unread with read=false) in one request: 
+        the entries of a feed, a list of entries, the entries updated before 
+        a time, or all of them. Returns the number of entries changed
+        """
+        serializer = MarkStateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        entries = filter_marked(Entry.objects.filter(feed__owner=request.user, feed__deleted=False), data)
+        count = Entry.objects.mark(entries, ENTRY_READ if data['read'] else ENTRY_UNREAD)
+
+        return Response({'count': count})
+
 class EntryDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, viewsets.GenericViewSet):
     """
     Entry Details
@@ -97,7 +225,7 @@ class EntryDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, viewsets.G
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Entry.objects.filter(feed__owner=self.request.user)
+        return Entry.objects.filter(feed__owner=self.request.user, feed__deleted=False).select_related('item')
 
     def update(self, request, *args, **kwargs):
         return Response("method not allowed", status=status.HTTP_401_UNAUTHORIZED)
@@ -126,6 +254,7 @@ class EntryDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, viewsets.G
 ####################################################
 ####################################################
 
+@method_decorator(condition(etag_func=user_etag), name='list')
 class FeedList(mixins.CreateModelMixin,mixins.ListModelMixin,viewsets.GenericViewSet):
     """
     Feed API
@@ -156,7 +285,7 @@ class FeedList(mixins.CreateModelMixin,mixins.ListModelMixin,viewsets.GenericVie
     def get_queryset(self):
         following = self.request.GET.get('following', None)
 
-        filter_kwargs ={"owner": self.request.user}
+        filter_kwargs ={"owner": self.request.user, "deleted": False}
  
         if following:
             if following == 'true' or following=='True':
@@ -166,6 +295,23 @@ class FeedList(mixins.CreateModelMixin,mixins.ListModelMixin,viewsets.GenericVie
 
         return Feed.objects.filter(**filter_kwargs)
 
+    @action(detail=False, methods=['get'])
+    @method_decorator(condition(etag_func=user_etag))
+    def counts(self, request):
+        """
+        The unread and total number of entries of every feed of the user, and 
+        over all of them, read from the stored counters
+        """
+        feeds = Feed.objects.filter(owner=request.user, deleted=False).order_by('id').values_list('id', 'unread_count', 'entry_count')
+        counter = UserCounter.objects.filter(user=request.user).values_list('unread_count', 'entry_count').first()
+        unread, total = counter or (0, 0)
+
+        return Response({
+            'unread': unread,
+            'total': total,
+            'feeds': [{'id': feed_id, 'unread': feed_unread, 'total': feed_total} for feed_id, feed_unread, feed_total in feeds],
+        })
+
 class FeedDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
     """
         Feed Detail API
@@ -187,7 +333,8 @@ class FeedDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, mixins.Dest
                   description: If set to true, will force an async update on the feed, default is false (true/false)
                   required: false
         delete:
-            Delete a feed entry. This action will also delete all referencing entries and notifications
+            Delete a feed entry. This action will also delete all referencing entries and notifications. 
+            The feed is hidden at once, its entries are deleted in the background
             parameter: force
     """
     permission_classes = [permissions.IsAuthenticated]
@@ -196,7 +343,10 @@ class FeedDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, mixins.Dest
     serializer_class = FeedSerializer
 
     def get_queryset(self):
-        return Feed.objects.filter(owner=self.request.user)
+        return Feed.objects.filter(owner=self.request.user, deleted=False)
+
+    def perform_destroy(self, instance):
+        instance.delete_later()
     
 
     def update(self, request, pk=None):
@@ -227,6 +377,14 @@ class FeedDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, mixins.Dest
         if nickname:
             feed.nickname = nickname
 
+        retention = {field: request.data[field] for field in ('retention_days', 'retention_max_entries') if field in request.data}
+        if retention:
+            serializer = FeedSerializer(feed, data=retention, partial=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            for field, value in serializer.validated_data.items():
+                setattr(feed, field, value)
+
         if follow:
             if follow == 'true' or follow=='True':
                 feed.following = True
@@ -247,17 +405,31 @@ class FeedDetail(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, mixins.Dest
 ####################################################
 ####################################################
 
+@method_decorator(condition(etag_func=user_etag), name='list')
 class NotificationList(mixins.ListModelMixin, viewsets.GenericViewSet):
     """
     get:
         View all notifications
+
+        parameters:
+            - name: read
+              in: path
+              type: boolean
+              description: filter based on read status
+              required: false
+            - name: count
+              in: path
+              type: boolean
+              description: include the total number of matching notifications (slower)
+              required: false
     """
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = UpdatedCursorPagination
 
     def get_queryset(self):
         read = self.request.GET.get('read', None)
 
-        filter_kwargs ={"feed__owner": self.request.user}
+        filter_kwargs ={"owner": self.request.user}
         
         if read:
             if read == 'true' or read=='True':
@@ -270,6 +442,25 @@ class NotificationList(mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
 
+    @action(detail=False, methods=['post'])
+    def mark(self, request):
+        """
+        Mark many notifications read (or unread with read=false) in one 
+        request, like the entries. Returns the number of notifications changed
+        """
+        serializer = MarkStateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        state = ENTRY_READ if data['read'] else ENTRY_UNREAD
+        notifications = filter_marked(Notification.objects.filter(owner=request.user), data)
+        count = notifications.exclude(state=state).update(state=state)
+        if count:
+            UserCounter.objects.touch([request.user.id])
+
+        return Response({'count': count})
+
 class NotificationUpdateState(viewsets.ModelViewSet):
     """
     Notification Details